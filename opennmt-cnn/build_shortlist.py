@@ -0,0 +1,33 @@
+#!/usr/bin/env python
+"""
+Build the target vocabulary shortlist table of translate.py -shortlist
+from the preprocessed train shards, e.g.
+
+    python build_shortlist.py -data data/gq -output data/gq.shortlist.pt
+"""
+import configargparse
+import torch
+
+import onmt.opts as opts
+from inputters.dataset import load_dataset
+from onmt.shortlist import build_shortlist
+from utils.logging import init_logger, logger
+
+
+def main(opt):
+    vocab = dict(torch.load(opt.data + '_vocab.pt'))
+    table = build_shortlist(load_dataset('train', opt), vocab['src'], vocab['tgt'],
+                            opt.shortlist_lexical, opt.shortlist_frequent)
+    torch.save(table, opt.output)
+    logger.info("Saved the shortlist table of %d source words to %s" % (table['lexical'].size(0), opt.output))
+
+
+if __name__ == "__main__":
+    parser = configargparse.ArgumentParser(
+        description='build_shortlist.py',
+        formatter_class=configargparse.ArgumentDefaultsHelpFormatter)
+    opts.shortlist_opts(parser)
+
+    opt = parser.parse_args()
+    init_logger()
+    main(opt)
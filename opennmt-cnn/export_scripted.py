@@ -0,0 +1,37 @@
+#!/usr/bin/env python
+"""
+Export a model as a TorchScript archive of its encoder, its incremental
+decoder step and its generator, with the vocab, e.g.
+
+    python export_scripted.py -model model.pt -output model.script.pt
+    python translate.py -model model.script.pt -scripted -src test.src ...
+
+The archive is exported on CPU and can be loaded on any device.
+"""
+import configargparse
+
+import onmt.opts as opts
+import onmt.transformer as nmt_model
+from onmt.scripted import export_scripted
+from utils.logging import init_logger, logger
+
+
+def main(opt):
+    dummy_parser = configargparse.ArgumentParser(description='export_scripted.py')
+    opts.model_opts(dummy_parser)
+    dummy_opt = dummy_parser.parse_known_args([])[0]
+
+    fields, model = nmt_model.load_test_model(opt, dummy_opt.__dict__)
+    export_scripted(model, fields, opt.output)
+    logger.info("Saved the scripted model to %s" % opt.output)
+
+
+if __name__ == "__main__":
+    parser = configargparse.ArgumentParser(
+        description='export_scripted.py',
+        formatter_class=configargparse.ArgumentDefaultsHelpFormatter)
+    opts.export_scripted_opts(parser)
+
+    opt = parser.parse_args()
+    init_logger()
+    main(opt)
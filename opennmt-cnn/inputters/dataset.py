@@ -2,8 +2,9 @@ import codecs
 import gc
 import glob
 import math
+import random
 from collections import defaultdict
-from itertools import chain
+from itertools import chain, islice
 
 import torch
 import torchtext.data
@@ -31,6 +32,19 @@ def make_text_iterator_from_file(path):
             yield line  # 每次遇到yield关键字后返回相应结果，并保留函数当前的运行状态，等待下一次的调用
 
 
+def make_chunked_iterators(data_iters, chunk_size):
+    """
+    Read the parallel `data_iters` (None entries stay None) `chunk_size`
+    lines at a time, yielding one tuple of line lists per chunk.
+    """
+    while True:
+        chunk = tuple(list(islice(data_iter, chunk_size)) if data_iter is not None else None
+                      for data_iter in data_iters)
+        if not chunk[0]:
+            return
+        yield chunk
+
+
 def make_features(batch, side):
     """
     Args:
@@ -39,8 +53,7 @@ def make_features(batch, side):
     Returns:
         A sequence of src/tgt tensors with optional feature tensors of size (len x batch).
     """
-    assert side in ['src', 'tgt', 'structure1', 'structure2', 'structure3', 'structure4', 'structure5', 'structure6',
-                    'structure7', 'structure8']
+    assert side in ['src', 'tgt'] or side.startswith('structure')
     if isinstance(batch.__dict__[side], tuple):  # isinstance()来判断一个对象是否是一个已知的类型
         data = batch.__dict__[side][0]
     else:
@@ -49,6 +62,124 @@ def make_features(batch, side):
     return data
 
 
+def make_structure_features(batch, n_structures):
+    """
+    Args:
+        batch (Tensor): a batch of structure data.
+        n_structures (int): number of structure channels to read.
+    Returns:
+        A list of `n_structures` tensors of size (len x len x batch).
+    """
+    structures = []
+    for name in structure_names(n_structures):
+        structure = make_features(batch, name)
+        structure = structure.transpose(0, 1)
+        structure = structure.transpose(1, 2)
+        structures.append(structure)
+    return structures
+
+
+class GraphPacking(object):
+    """
+    The graphs of a batch packed side by side into fewer rows, so that small
+    graphs do not pay for the n^2 structure of the largest one. Each row
+    holds one or more graphs, the structure of a row is block diagonal and
+    attention is masked to the graph a position belongs to.
+
+    Attributes:
+        src (LongTensor): packed source `[len x rows]`.
+        structures (list): packed structure channels `[len x len x rows]`.
+        positions (LongTensor): position of every token inside its own graph
+            `[len x rows]`, the positional encoding restarts for each graph.
+        mask (BoolTensor): attention mask `[rows x len x len]`, set where a
+            query and a key belong to different graphs or the key is padding.
+        index (LongTensor): for every graph and position of the unpacked
+            batch, the flat position `row * len + offset + position` it was
+            packed at `[batch x len]`.
+        n_cells (int): structure cells actually covered by the graphs.
+        n_padded_cells (int): structure cells of the padded, unpacked batch.
+        n_packed_cells (int): structure cells of the packed batch.
+    """
+
+    def __init__(self, src, structures, positions, mask, index, n_cells, n_padded_cells):
+        self.src = src
+        self.structures = structures
+        self.positions = positions
+        self.mask = mask
+        self.index = index
+        self.n_cells = n_cells
+        self.n_padded_cells = n_padded_cells
+        self.n_packed_cells = src.size(1) * src.size(0) ** 2
+
+    def unpack(self, packed):
+        """
+        Scatter a packed `[rows x len x dim]` tensor back to the layout of
+        the batch, `[batch x len x dim]`. Positions past the end of a graph
+        are padding and are filled with its first position.
+        """
+        rows, length, dim = packed.size()
+        batch_size = self.index.size(0)
+        unpacked = packed.reshape(rows * length, dim).index_select(0, self.index.view(-1))
+        return unpacked.view(batch_size, length, dim)
+
+
+def pack_graphs(src, structures, lengths, src_pad_idx, structure_pad_idx):
+    """
+    Pack the graphs of a batch first-fit decreasing into rows as long as the
+    longest graph.
+
+    Args:
+        src (LongTensor): source `[len x batch]`.
+        structures (list): structure channels `[len x len x batch]`.
+        lengths (LongTensor): source lengths `[batch]`.
+        src_pad_idx (int): padding index of the source vocab.
+        structure_pad_idx (int): padding index of the structure vocab.
+    Returns:
+        A :obj:`GraphPacking`.
+    """
+    length, batch_size = src.size()
+    lengths = lengths.tolist()
+
+    # (row, offset) of every graph, longest graphs placed first.
+    placement = [None] * batch_size
+    rows = []
+    for b in sorted(range(batch_size), key=lambda b: -lengths[b]):
+        for r, used in enumerate(rows):
+            if used + lengths[b] <= length:
+                placement[b] = (r, used)
+                rows[r] += lengths[b]
+                break
+        else:
+            placement[b] = (len(rows), 0)
+            rows.append(lengths[b])
+    n_rows = len(rows)
+
+    packed_src = src.new_full((length, n_rows), src_pad_idx)
+    positions = src.new_zeros((length, n_rows))
+    segments = src.new_zeros((length, n_rows))
+    index = src.new_zeros((batch_size, length))
+    packed_structures = [structure.new_full((length, length, n_rows), structure_pad_idx)
+                         for structure in structures]
+    for b, (r, offset) in enumerate(placement):
+        n = lengths[b]
+        end = offset + n
+        steps = torch.arange(n, device=src.device)
+        packed_src[offset:end, r] = src[:n, b]
+        positions[offset:end, r] = steps
+        segments[offset:end, r] = b + 1
+        index[b] = r * length + offset
+        index[b, :n] += steps
+        for packed, structure in zip(packed_structures, structures):
+            packed[offset:end, offset:end, r] = structure[:n, :n, b]
+
+    segments = segments.t()
+    mask = segments.unsqueeze(2).ne(segments.unsqueeze(1)) | segments.eq(0).unsqueeze(1)
+
+    return GraphPacking(packed_src, packed_structures, positions, mask, index,
+                        n_cells=sum(n * n for n in lengths),
+                        n_padded_cells=batch_size * length ** 2)
+
+
 def save_fields_to_vocab(fields):
     """
     Save Vocab objects in Field objects to `vocab.pt` file.
@@ -93,30 +224,20 @@ def get_target_fields(fields=None):
     return fields
 
 
-def get_structure1_fields(fields=None):
-    if fields is None:
-        fields = {}
-
-    nesting_field = torchtext.data.Field(
-        pad_token=Constants.PAD_WORD)
+def structure_names(n_structures):
+    """ Names of the first `n_structures` structure channels. """
+    return ['structure%d' % (i + 1) for i in range(n_structures)]
 
-    fields["structure1"] = torchtext.data.NestedField(nesting_field, pad_token=Constants.PAD_WORD)
 
-    fields["indices"] = torchtext.data.Field(
-        use_vocab=False, dtype=torch.long,
-        sequential=False)
-
-    return fields
-
-
-def get_structure2_fields(fields=None):
+def get_structure_fields(n_structures, fields=None):
     if fields is None:
         fields = {}
 
-    nesting_field = torchtext.data.Field(
-        pad_token=Constants.PAD_WORD)
+    for name in structure_names(n_structures):
+        nesting_field = torchtext.data.Field(
+            pad_token=Constants.PAD_WORD)
 
-    fields["structure2"] = torchtext.data.NestedField(nesting_field, pad_token=Constants.PAD_WORD)
+        fields[name] = torchtext.data.NestedField(nesting_field, pad_token=Constants.PAD_WORD)
 
     fields["indices"] = torchtext.data.Field(
         use_vocab=False, dtype=torch.long,
@@ -125,154 +246,51 @@ def get_structure2_fields(fields=None):
     return fields
 
 
-def get_structure3_fields(fields=None):
-    if fields is None:
-        fields = {}
-
-    nesting_field = torchtext.data.Field(
-        pad_token=Constants.PAD_WORD)
-
-    fields["structure3"] = torchtext.data.NestedField(nesting_field, pad_token=Constants.PAD_WORD)
-
-    fields["indices"] = torchtext.data.Field(
-        use_vocab=False, dtype=torch.long,
-        sequential=False)
-
-    return fields
-
-
-def get_structure4_fields(fields=None):
-    if fields is None:
-        fields = {}
-
-    nesting_field = torchtext.data.Field(
-        pad_token=Constants.PAD_WORD)
-
-    fields["structure4"] = torchtext.data.NestedField(nesting_field, pad_token=Constants.PAD_WORD)
-
-    fields["indices"] = torchtext.data.Field(
-        use_vocab=False, dtype=torch.long,
-        sequential=False)
-
-    return fields
-
-
-def get_structure5_fields(fields=None):
-    if fields is None:
-        fields = {}
-
-    nesting_field = torchtext.data.Field(
-        pad_token=Constants.PAD_WORD)
-
-    fields["structure5"] = torchtext.data.NestedField(nesting_field, pad_token=Constants.PAD_WORD)
-
-    fields["indices"] = torchtext.data.Field(
-        use_vocab=False, dtype=torch.long,
-        sequential=False)
-
-    return fields
-
-
-# def get_structure6_fields(fields=None):
-#   if fields is None:
-#     fields = {}
-#
-#   nesting_field = torchtext.data.Field(
-#     pad_token=Constants.PAD_WORD)
-#
-#   fields["structure6"] = torchtext.data.NestedField(nesting_field, pad_token=Constants.PAD_WORD)
-#
-#   fields["indices"] = torchtext.data.Field(
-#       use_vocab=False, dtype=torch.long,
-#       sequential=False)
-#
-#   return fields
-#
-# def get_structure7_fields(fields=None):
-#   if fields is None:
-#     fields = {}
-#
-#   nesting_field = torchtext.data.Field(
-#     pad_token=Constants.PAD_WORD)
-#
-#   fields["structure7"] = torchtext.data.NestedField(nesting_field, pad_token=Constants.PAD_WORD)
-#
-#   fields["indices"] = torchtext.data.Field(
-#       use_vocab=False, dtype=torch.long,
-#       sequential=False)
-#
-#   return fields
-#
-# def get_structure8_fields(fields=None):
-#   if fields is None:
-#     fields = {}
-#
-#   nesting_field = torchtext.data.Field(
-#     pad_token=Constants.PAD_WORD)
-#
-#   fields["structure8"] = torchtext.data.NestedField(nesting_field, pad_token=Constants.PAD_WORD)
-#
-#   fields["indices"] = torchtext.data.Field(
-#       use_vocab=False, dtype=torch.long,
-#       sequential=False)
-#
-#   return fields
-
-
-def get_fields():
+def get_fields(n_structures):
     fields = {}
 
     fields = get_source_fields(fields)
     fields = get_target_fields(fields)
-    fields = get_structure1_fields(fields)
-    fields = get_structure2_fields(fields)
-    fields = get_structure3_fields(fields)
-    fields = get_structure4_fields(fields)
-    fields = get_structure5_fields(fields)
-    # fields = get_structure6_fields(fields)
-    # fields = get_structure7_fields(fields)
-    # fields = get_structure8_fields(fields)
+    fields = get_structure_fields(n_structures, fields)
 
     return fields
 
 
-def load_fields_from_vocab(vocab):
+def load_fields_from_vocab(vocab, n_structures):
     """
-    Load Field objects from `vocab.pt` file.
+    Load Field objects from `vocab.pt` file, keeping the first
+    `n_structures` structure channels.
     """
     vocab = dict(vocab)
-    fields = get_fields()
+    fields = get_fields(n_structures)
+    for name in structure_names(n_structures):
+        if name not in vocab:
+            raise AssertionError('The model uses %d structure channels but the vocab '
+                                 'has no %s' % (n_structures, name))
     for k, v in vocab.items():
+        if k not in fields:
+            continue
         # Hack. Can't pickle defaultdict :(
         v.stoi = defaultdict(lambda: 0, v.stoi)
         fields[k].vocab = v
+    for name in structure_names(n_structures):
+        fields[name].nesting_field.vocab = fields[name].vocab
     return fields
 
 
-def load_fields(opt, checkpoint):
+def load_fields(opt, checkpoint, n_structures):
     if checkpoint is not None:
         logger.info('Loading vocab from checkpoint at %s.' % opt.train_from)
-        fields = load_fields_from_vocab(checkpoint['vocab'])
+        fields = load_fields_from_vocab(checkpoint['vocab'], n_structures)
     else:
-        fields = load_fields_from_vocab(torch.load(opt.data + '_vocab.pt'))
-    fields['structure1'].nesting_field.vocab = fields['structure1'].vocab
-    fields['structure2'].nesting_field.vocab = fields['structure2'].vocab
-    fields['structure3'].nesting_field.vocab = fields['structure3'].vocab
-    fields['structure4'].nesting_field.vocab = fields['structure4'].vocab
-    fields['structure5'].nesting_field.vocab = fields['structure5'].vocab
-    # fields['structure6'].nesting_field.vocab = fields['structure6'].vocab
-    # fields['structure7'].nesting_field.vocab = fields['structure7'].vocab
-    # fields['structure8'].nesting_field.vocab = fields['structure8'].vocab
+        fields = load_fields_from_vocab(torch.load(opt.data + '_vocab.pt'), n_structures)
     logger.info(
-        ' * vocabulary size. source = %d; target = %d; structure1 = %d; structure2 = %d; structure3 = %d; structure4 = %d; structure5 = %d; '
+        ' * vocabulary size. source = %d; target = %d; %s'
         %
         (len(fields['src'].vocab),
          len(fields['tgt'].vocab),
-         len(fields['structure1'].nesting_field.vocab),
-         len(fields['structure2'].nesting_field.vocab),
-         len(fields['structure3'].nesting_field.vocab),
-         len(fields['structure4'].nesting_field.vocab),
-         len(fields['structure5'].nesting_field.vocab)))
+         '; '.join('%s = %d' % (name, len(fields[name].nesting_field.vocab))
+                   for name in structure_names(n_structures))))
 
     return fields
 
@@ -288,20 +306,33 @@ class DatasetIter(object):
         batch_size_fn: custom batch process function.
         device: the GPU device.
         is_train (bool): train or valid?
+        iter_state (dict): a state from `state_dict`; the iterator then
+            starts at the saved shard and batch. `datasets` must already
+            skip the shards before `iter_state['shard']`.
+        resident (bool): the datasets are kept in memory across epochs,
+            so their examples are not dropped after use.
     """
 
     def __init__(self, datasets, fields, batch_size, batch_size_fn,
-                 device, is_train):
+                 device, is_train, iter_state=None, resident=False):
         self.datasets = datasets
         self.fields = fields
         self.batch_size = batch_size
         self.batch_size_fn = batch_size_fn
         self.device = device
         self.is_train = is_train
+        self.resident = resident
+        self.cur_shard = -1 if iter_state is None else iter_state['shard'] - 1
 
+        if iter_state is not None:
+            random.setstate(iter_state['random_state'])
         self.cur_iter = self._next_dataset_iterator(datasets)
         # We have at least one dataset.
         assert self.cur_iter is not None
+        if iter_state is not None:
+            # torchtext rebuilds the batch plan from the saved random state
+            # and fast-forwards the cursor without building earlier batches.
+            self.cur_iter.load_state_dict(iter_state['iterator'])
 
     def __iter__(self):
         dataset_iter = (d for d in self.datasets)
@@ -318,10 +349,19 @@ class DatasetIter(object):
         assert self.cur_iter is not None
         return len(self.cur_iter)
 
+    def state_dict(self):
+        """ Position of the iterator: shard index, batch cursor inside
+            the shard and the random state used to build the batch plan.
+        """
+        assert self.cur_iter is not None
+        return {'shard': self.cur_shard,
+                'iterator': self.cur_iter.state_dict(),
+                'random_state': random.getstate()}
+
     def _next_dataset_iterator(self, dataset_iter):
         try:
             # Drop the current dataset for decreasing memory
-            if hasattr(self, "cur_dataset"):
+            if hasattr(self, "cur_dataset") and not self.resident:
                 self.cur_dataset.examples = None
                 gc.collect()
                 del self.cur_dataset
@@ -330,6 +370,7 @@ class DatasetIter(object):
             self.cur_dataset = next(dataset_iter)
         except StopIteration:
             return None
+        self.cur_shard += 1
 
         # We clear `fields` when saving, restore when loading.
         self.cur_dataset.fields = self.fields
@@ -344,6 +385,50 @@ class DatasetIter(object):
             repeat=False)
 
 
+class ResidentBatchIter(object):
+    """ Iterates over padded batches kept in memory for the whole run.
+
+    The batches are built once by `build_resident_batches`; a new epoch only
+    reshuffles their order. `state_dict` follows `DatasetIter.state_dict`.
+
+    Args:
+        batches (list): the `torchtext.data.Batch` objects.
+        is_train (bool): train or valid? Valid batches are not shuffled.
+        iter_state (dict): a state from `state_dict` to resume from.
+    """
+
+    def __init__(self, batches, is_train, iter_state=None):
+        self.batches = batches
+        self.is_train = is_train
+        self.cursor = 0
+
+        if iter_state is not None:
+            random.setstate(iter_state['iterator']['random_state_this_epoch'])
+            self.cursor = iter_state['iterator']['iterations_this_epoch']
+        self.random_state_this_epoch = random.getstate()
+        self.order = list(range(len(batches)))
+        if is_train:
+            random.shuffle(self.order)
+        if iter_state is not None:
+            random.setstate(iter_state['random_state'])
+
+    def __iter__(self):
+        while self.cursor < len(self.order):
+            batch = self.batches[self.order[self.cursor]]
+            self.cursor += 1
+            yield batch
+
+    def __len__(self):
+        return len(self.batches)
+
+    def state_dict(self):
+        return {'shard': 0,
+                'iterator': {'iterations': self.cursor,
+                             'iterations_this_epoch': self.cursor,
+                             'random_state_this_epoch': self.random_state_this_epoch},
+                'random_state': random.getstate()}
+
+
 class OrderedIterator(torchtext.data.Iterator):
     """ Ordered Iterator Class """
 
@@ -363,7 +448,7 @@ class OrderedIterator(torchtext.data.Iterator):
                 self.batches.append(sorted(b, key=self.sort_key))
 
 
-def load_dataset(corpus_type, opt):
+def load_dataset(corpus_type, opt, shard_offset=0):
     assert corpus_type in ["train", "valid"]
 
     def _dataset_loader(pt_file, corpus_type):
@@ -375,7 +460,8 @@ def load_dataset(corpus_type, opt):
     # Sort the glob output by file name (by increasing indexes).
     pts = sorted(glob.glob(opt.data + '_' + corpus_type + '.[0-9]*.pt'))
     if pts:
-        for pt in pts:
+        # Shards before `shard_offset` are skipped without being loaded.
+        for pt in pts[shard_offset:]:
             yield _dataset_loader(pt, corpus_type)
     else:
         pt = opt.data + '_' + corpus_type + '.pt'
@@ -385,11 +471,7 @@ def load_dataset(corpus_type, opt):
 def build_dataset(fields,
                   src_data_iter,
                   tgt_data_iter,
-                  structure_data_iter1,
-                  structure_data_iter2,
-                  structure_data_iter3,
-                  structure_data_iter4,
-                  structure_data_iter5,
+                  structure_data_iters,
                   src_seq_length=0,
                   tgt_seq_length=0,
                   src_seq_length_trunc=0,
@@ -403,52 +485,12 @@ def build_dataset(fields,
     else:
         tgt_examples_iter = None
 
-    if structure_data_iter1 != None:
-        structure_examples_iter1 = Dataset.make_nested_examples(structure_data_iter1, None, "structure1")
-    else:
-        structure_examples_iter1 = None
-
-    if structure_data_iter2 != None:
-        structure_examples_iter2 = Dataset.make_nested_examples(structure_data_iter2, None, "structure2")
-    else:
-        structure_examples_iter2 = None
-
-    if structure_data_iter3 != None:
-        structure_examples_iter3 = Dataset.make_nested_examples(structure_data_iter3, None, "structure3")
-    else:
-        structure_examples_iter3 = None
-
-    if structure_data_iter4 != None:
-        structure_examples_iter4 = Dataset.make_nested_examples(structure_data_iter4, None, "structure4")
-    else:
-        structure_examples_iter4 = None
-
-    if structure_data_iter5 != None:
-        structure_examples_iter5 = Dataset.make_nested_examples(structure_data_iter5, None, "structure5")
-    else:
-        structure_examples_iter5 = None
-
-    # if structure_data_iter6 != None:
-    #   structure_examples_iter6 = Dataset.make_nested_examples(structure_data_iter6, None, "structure6")
-    # else:
-    #   structure_examples_iter6 = None
-    #
-    # if structure_data_iter7 != None:
-    #   structure_examples_iter7 = Dataset.make_nested_examples(structure_data_iter7, None, "structure7")
-    # else:
-    #   structure_examples_iter7 = None
-    #
-    # if structure_data_iter8 != None:
-    #   structure_examples_iter8 = Dataset.make_nested_examples(structure_data_iter8, None, "structure8")
-    # else:
-    #   structure_examples_iter8 = None
+    structure_examples_iters = [Dataset.make_nested_examples(structure_data_iter, None, name)
+                                for name, structure_data_iter
+                                in zip(structure_names(len(structure_data_iters)), structure_data_iters)]
 
     dataset = Dataset(fields, src_examples_iter, tgt_examples_iter,
-                      structure_examples_iter1,
-                      structure_examples_iter2,
-                      structure_examples_iter3,
-                      structure_examples_iter4,
-                      structure_examples_iter5,
+                      structure_examples_iters,
                       src_seq_length=src_seq_length,
                       tgt_seq_length=tgt_seq_length,
                       use_filter_pred=use_filter_pred)
@@ -456,7 +498,7 @@ def build_dataset(fields,
     return dataset
 
 
-def build_dataset_iter(datasets, fields, opt, is_train=True):
+def build_dataset_iter(datasets, fields, opt, is_train=True, iter_state=None, resident=False):
     """
     This returns user-defined train/validate data iterator for the trainer
     to iterate over. We implement simple ordered iterator strategy here,
@@ -491,18 +533,26 @@ def build_dataset_iter(datasets, fields, opt, is_train=True):
     else:
         device = "cpu"
 
-    return DatasetIter(datasets, fields, batch_size, batch_size_fn, device, is_train)
+    return DatasetIter(datasets, fields, batch_size, batch_size_fn, device, is_train,
+                       iter_state=iter_state, resident=resident)
+
+
+def build_resident_batches(datasets, fields, opt, is_train=True):
+    """
+    Numericalize and pad all batches of the in-memory `datasets` once,
+    to be iterated by `ResidentBatchIter` in every epoch.
+    """
+    # Iterated, as the length of a torchtext iterator with a batch_size_fn is not defined.
+    batches = [batch for batch in build_dataset_iter(iter(datasets), fields, opt, is_train, resident=True)]
+    logger.info('Keeping %d %s batches in memory' % (len(batches), 'train' if is_train else 'valid'))
+    return batches
 
 
 class Dataset(torchtext.data.Dataset):
     def __init__(self, fields,
                  src_examples_iter,
                  tgt_examples_iter,
-                 structure_examples_iter1,
-                 structure_examples_iter2,
-                 structure_examples_iter3,
-                 structure_examples_iter4,
-                 structure_examples_iter5,
+                 structure_examples_iters,
                  src_seq_length=0, tgt_seq_length=0,
                  use_filter_pred=True):
 
@@ -512,46 +562,19 @@ class Dataset(torchtext.data.Dataset):
             return dict(chain(*[d.items() for d in args]))
 
         out_fields = get_source_fields()
-        if tgt_examples_iter is not None and structure_examples_iter1 is not None:
-            examples_iter = (_join_dicts(src, tgt, structure1, structure2, structure3, structure4, structure5)
-                             for src, tgt, structure1, structure2, structure3, structure4, structure5
+        if tgt_examples_iter is not None:
+            examples_iter = (_join_dicts(src, tgt, *structures)
+                             for src, tgt, *structures
                              in zip(src_examples_iter,
                                     tgt_examples_iter,
-                                    structure_examples_iter1,
-                                    structure_examples_iter2,
-                                    structure_examples_iter3,
-                                    structure_examples_iter4,
-                                    structure_examples_iter5,
-                                    ))
+                                    *structure_examples_iters))
             out_fields = get_target_fields(out_fields)
-            out_fields = get_structure1_fields(out_fields)
-            out_fields = get_structure2_fields(out_fields)
-            out_fields = get_structure3_fields(out_fields)
-            out_fields = get_structure4_fields(out_fields)
-            out_fields = get_structure5_fields(out_fields)
-
         else:
-            # examples_iter = src_examples_iter
-            examples_iter = (_join_dicts(src, structure1, structure2, structure3, structure4, structure5)
-                             for src, structure1, structure2, structure3, structure4, structure5
+            examples_iter = (_join_dicts(src, *structures)
+                             for src, *structures
                              in zip(src_examples_iter,
-                                    structure_examples_iter1,
-                                    structure_examples_iter2,
-                                    structure_examples_iter3,
-                                    structure_examples_iter4,
-                                    structure_examples_iter5,
-                                    ))
-            out_fields = get_structure1_fields(out_fields)
-            out_fields = get_structure2_fields(out_fields)
-            out_fields = get_structure3_fields(out_fields)
-            out_fields = get_structure4_fields(out_fields)
-            out_fields = get_structure5_fields(out_fields)
-
-            fields['structure1'].nesting_field.vocab = fields['structure1'].vocab
-            fields['structure2'].nesting_field.vocab = fields['structure2'].vocab
-            fields['structure3'].nesting_field.vocab = fields['structure3'].vocab
-            fields['structure4'].nesting_field.vocab = fields['structure4'].vocab
-            fields['structure5'].nesting_field.vocab = fields['structure5'].vocab
+                                    *structure_examples_iters))
+        out_fields = get_structure_fields(len(structure_examples_iters), out_fields)
 
         keys = out_fields.keys()  # dict_keys(['src', 'indices', 'tgt', 'structure','index'])
 
@@ -1,34 +1,67 @@
 """ Embeddings module """
 import math
+import threading
 
 import torch
 import torch.nn as nn
 
+# Sinusoid tables shared by all PositionalEncoding modules, per dim and device.
+_position_tables = {}
+_position_tables_lock = threading.Lock()
+
+
+def get_position_table(dim, length, device):
+    """
+    Sinusoid table `[len x 1 x dim]` of at least `length` positions. The
+    table is built on first use and grown on demand, it is not part of
+    any state_dict.
+    """
+    key = (dim, device)
+    with _position_tables_lock:
+        pe = _position_tables.get(key)
+        if pe is None or pe.size(0) < length:
+            if pe is not None:
+                length = max(length, 2 * pe.size(0))
+            pe = torch.zeros(length, dim)  # pe   10000 * 512
+            position = torch.arange(0, length).unsqueeze(1)
+            div_term = torch.exp((torch.arange(0, dim, 2, dtype=torch.float) *
+                                  -(math.log(10000.0) / dim)))
+            pe[:, 0::2] = torch.sin(position.float() * div_term)
+            pe[:, 1::2] = torch.cos(position.float() * div_term)
+            pe = pe.unsqueeze(1).to(device)
+            _position_tables[key] = pe
+    return pe
 
-class PositionalEncoding(nn.Module):
-    def __init__(self, dropout, dim, max_len=5000):  # dim: 模型维度 512
-        pe = torch.zeros(max_len, dim)  # pe   10000 * 512
-        position = torch.arange(0, max_len).unsqueeze(1)
-        div_term = torch.exp((torch.arange(0, dim, 2, dtype=torch.float) *
-                              -(math.log(10000.0) / dim)))
-        pe[:, 0::2] = torch.sin(position.float() * div_term)
-        pe[:, 1::2] = torch.cos(position.float() * div_term)
-        pe = pe.unsqueeze(1)
 
+class PositionalEncoding(nn.Module):
+    def __init__(self, dropout, dim):  # dim: 模型维度 512
         super(PositionalEncoding, self).__init__()
-        self.register_buffer('pe', pe)
         self.dropout = nn.Dropout(p=dropout)
         self.dim = dim
 
     def forward(self, emb, step=None, is_encoder=False):
+        """
+        `step` is None for positions 0..len-1, an int for a single step, or
+        a LongTensor `[len x batch]` giving the position of every token.
+        """
 
         emb = emb * math.sqrt(self.dim)  # emb  12 * 146 * 512 / 12 * 12 * 146 * 64     pe [5000, 1, 512/64]
+        if step is None or torch.is_tensor(step):
+            # Tensor steps are positions within the rows, below emb.size(0).
+            length = emb.size(0)
+        elif is_encoder:
+            length = max(step + 1, emb.size(0))
+        else:
+            length = step + 1
+        pe = get_position_table(self.dim, length, emb.device)
         if step is None:
-            emb = emb + self.pe[:emb.size(0)]
+            emb = emb + pe[:emb.size(0)]
+        elif torch.is_tensor(step):
+            emb = emb + pe[step, 0]
         else:
-            emb = emb + self.pe[step]
+            emb = emb + pe[step]
             if is_encoder:
-                emb = emb + self.pe[:emb.size(0)]
+                emb = emb + pe[:emb.size(0)]
         emb = self.dropout(emb)
         return emb
 
@@ -0,0 +1,405 @@
+"""
+TorchScript versions of the encoder and of one incremental decoder step,
+for inference without the per step Python overhead of the modules.
+
+:obj:`ScriptableModel` shares the weights of a trained model and is
+compiled with `torch.jit.script` by export_scripted.py. The decoder step
+takes its cache as explicit tensors, with all layers stacked:
+
+* memory keys/values `[layers x batch x heads x src_len x dim_per_head]`,
+  one entry per sentence, computed once by `decoder.memory`
+* self attention keys/values `[layers x n x heads x max_len x dim_per_head]`,
+  one entry per hypothesis, written in place at `step`
+
+:obj:`ScriptedModel` loads such an archive and gives it the interface of
+:obj:`onmt.transformer.NMTModel` that the translator uses. The scripted
+modules are for inference only: they have no dropout, attend all queries
+at once whatever -attention_max_memory, and do not take packed graphs.
+"""
+import io
+import math
+import threading
+from typing import List, Optional, Tuple
+
+import torch
+import torch.nn as nn
+
+from inputters.dataset import load_fields_from_vocab, save_fields_to_vocab
+
+
+class ScriptableEmbeddings(nn.Module):
+    """ :obj:`onmt.embeddings.Embeddings` in eval mode """
+
+    def __init__(self, embeddings):
+        super(ScriptableEmbeddings, self).__init__()
+        self.word_lut = embeddings.word_lut
+        self.dim = embeddings.embedding_size
+        self.position_encoding = embeddings.position_encoding
+        self.register_buffer('div_term', torch.exp((torch.arange(0, self.dim, 2, dtype=torch.float) *
+                                                    -(math.log(10000.0) / self.dim))))
+
+    def forward(self, words: torch.Tensor, positions: torch.Tensor) -> torch.Tensor:
+        """
+        Embed `words` `[len x batch]` (or any shape), adding the sinusoid of
+        `positions`, which is broadcast against `words`.
+        """
+        emb = self.word_lut(words)
+        if not self.position_encoding:
+            return emb
+        angles = positions.float().unsqueeze(-1) * self.div_term
+        pe = torch.stack((torch.sin(angles), torch.cos(angles)), -1).flatten(-2)
+        return emb * math.sqrt(self.dim) + pe
+
+
+class ScriptableAttention(nn.Module):
+    """ :obj:`onmt.sublayer.MultiHeadedAttention` in eval mode """
+
+    def __init__(self, attention):
+        super(ScriptableAttention, self).__init__()
+        self.linear_keys = attention.linear_keys
+        self.linear_values = attention.linear_values
+        self.linear_query = attention.linear_query
+        self.linear_structure_k = attention.linear_structure_k
+        self.linear_structure_v = attention.linear_structure_v
+        self.final_linear = attention.final_linear
+        self.head_count = attention.head_count
+        self.dim_per_head = attention.dim_per_head
+
+    def shape(self, x: torch.Tensor) -> torch.Tensor:
+        return x.view(x.size(0), -1, self.head_count, self.dim_per_head).transpose(1, 2)
+
+    def project(self, key: torch.Tensor, value: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
+        """ Keys and values `[batch x heads x key_len x dim_per_head]` """
+        return self.shape(self.linear_keys(key)), self.shape(self.linear_values(value))
+
+    def forward(self, query: torch.Tensor, key: torch.Tensor, value: torch.Tensor,
+                mask: Optional[torch.Tensor] = None, structure: Optional[torch.Tensor] = None,
+                relation_ids: Optional[torch.Tensor] = None) -> torch.Tensor:
+        """
+        Attend the `query` vectors `[batch (* n) x query_len x dim]` over
+        the projected `key` and `value`, see :obj:`project`.
+        """
+        batch_size = key.size(0)
+        query_batch = query.size(0)
+        if query_batch != batch_size:
+            query = query.contiguous().view(batch_size, -1, query.size(-1))
+        query = self.shape(self.linear_query(query))
+        query = query / math.sqrt(self.dim_per_head)
+
+        scores = torch.matmul(query, key.transpose(2, 3))
+        structure_v: Optional[torch.Tensor] = None
+        if structure is not None:
+            structure_k = self.linear_structure_k(structure)
+            structure_v = self.linear_structure_v(structure)
+            if relation_ids is not None:
+                relation_ids = relation_ids.unsqueeze(1).expand(-1, self.head_count, -1, -1)
+                scores_k = torch.matmul(query, structure_k.t())
+                scores = scores + scores_k.gather(3, relation_ids)
+            else:
+                scores_k = torch.matmul(query.transpose(1, 2), structure_k.transpose(2, 3))
+                scores = scores + scores_k.transpose(1, 2)
+        if mask is not None:
+            scores = scores.masked_fill(mask.unsqueeze(1), -1e18)
+
+        attn = torch.softmax(scores, -1)
+        context = torch.matmul(attn, value)
+        if structure_v is not None:
+            if relation_ids is not None:
+                relation_attn = attn.new_zeros(attn.size(0), attn.size(1), attn.size(2), structure_v.size(0))
+                relation_attn.scatter_add_(3, relation_ids, attn)
+                context = context + torch.matmul(relation_attn, structure_v)
+            else:
+                context_v = torch.matmul(attn.transpose(1, 2), structure_v)
+                context = context + context_v.transpose(1, 2)
+
+        context = context.transpose(1, 2).contiguous().view(batch_size, -1, self.head_count * self.dim_per_head)
+        output = self.final_linear(context)
+        if query_batch != batch_size:
+            output = output.view(query_batch, -1, output.size(-1))
+        return output
+
+
+class ScriptableStructureEncoder(nn.Module):
+    """ :obj:`onmt.transformer_encoder.TransformerEncoderLayer.encode_structure` """
+
+    def __init__(self, layer):
+        super(ScriptableStructureEncoder, self).__init__()
+        self.cnn = layer.cnn
+        self.structure_layer_norm = layer.structure_layer_norm
+
+    def forward(self, paths: torch.Tensor) -> torch.Tensor:
+        structure = torch.relu(self.cnn(paths.transpose(1, 2).contiguous()))
+        return self.structure_layer_norm(structure.view(-1, 64))
+
+
+class ScriptableEncoderLayer(nn.Module):
+    """ :obj:`onmt.transformer_encoder.TransformerEncoderLayer` """
+
+    def __init__(self, layer):
+        super(ScriptableEncoderLayer, self).__init__()
+        self.self_attn = ScriptableAttention(layer.self_attn)
+        self.encode_structure = hasattr(layer, 'cnn')
+        if self.encode_structure:
+            self.structure_encoder = ScriptableStructureEncoder(layer)
+        else:
+            self.structure_encoder = nn.Identity()
+        self.feed_forward = layer.feed_forward
+        self.att_layer_norm = layer.att_layer_norm
+        self.ffn_layer_norm = layer.ffn_layer_norm
+
+    def forward(self, inputs: torch.Tensor, structure: torch.Tensor, mask: torch.Tensor,
+                relation_ids: Optional[torch.Tensor]) -> torch.Tensor:
+        input_norm = self.att_layer_norm(inputs)
+        key, value = self.self_attn.project(input_norm, input_norm)
+        inputs = self.self_attn(input_norm, key, value, mask, structure, relation_ids) + inputs
+        return self.feed_forward(self.ffn_layer_norm(inputs)) + inputs
+
+
+class ScriptableEncoder(nn.Module):
+    """ :obj:`onmt.transformer_encoder.TransformerEncoder` without packing """
+
+    def __init__(self, encoder):
+        super(ScriptableEncoder, self).__init__()
+        self.embeddings = ScriptableEmbeddings(encoder.embeddings)
+        self.structure_embeddings = ScriptableEmbeddings(encoder.structure_embeddings)
+        self.padding_idx = encoder.embeddings.word_padding_idx
+        self.n_structures = encoder.n_structures
+        self.structure_paths = encoder.structure_paths
+        self.structure_attention = encoder.structure_attention
+        self.transformer = nn.ModuleList([ScriptableEncoderLayer(layer) for layer in encoder.transformer])
+        self.layer_norm = encoder.layer_norm
+
+    def forward(self, src: torch.Tensor, structures: List[torch.Tensor]) -> Tuple[torch.Tensor, torch.Tensor]:
+        """
+        Encode `src` `[src_len x batch]` and its `structures`
+        `[src_len x src_len x batch]`, returns the embeddings and the
+        memory bank `[src_len x batch x dim]`.
+        """
+        emb = self.embeddings(src, torch.arange(src.size(0), device=src.device).unsqueeze(1))
+
+        edge_size = structures[0].size(0)
+        batch_size = structures[0].size(2)
+        path_index: Optional[torch.Tensor] = None
+        if self.structure_paths == 'unique':
+            paths = torch.stack(structures, -1).permute(2, 0, 1, 3)
+            paths, path_index = torch.unique(paths.reshape(-1, self.n_structures), dim=0, return_inverse=True)
+            output_structure = torch.stack([
+                self.structure_embeddings(paths[:, i], torch.full([1], i, device=src.device))
+                for i in range(self.n_structures)], 1)
+        else:
+            structure_embs: List[torch.Tensor] = []
+            for i, structure in enumerate(structures):
+                structure_emb = self.structure_embeddings(structure, torch.full([1], i, device=src.device))
+                structure_embs.append(structure_emb.view(-1, 1, batch_size, 64).contiguous())
+            output_structure = torch.cat(structure_embs, 1)
+            output_structure = output_structure.transpose(0, 1).contiguous()
+            output_structure = output_structure.transpose(0, 2).contiguous()
+            output_structure = output_structure.view(-1, self.n_structures, 64)
+
+        out = emb.transpose(0, 1).contiguous()
+        mask = src.transpose(0, 1).eq(self.padding_idx).unsqueeze(1)
+        structure = output_structure
+        relation_ids: Optional[torch.Tensor] = None
+        for layer in self.transformer:
+            if layer.encode_structure:
+                structure = layer.structure_encoder(output_structure)
+                if self.structure_attention == 'index':
+                    assert path_index is not None
+                    relation_ids = path_index.view(batch_size, edge_size, edge_size)
+                else:
+                    if path_index is not None:
+                        structure = structure.index_select(0, path_index.view(-1))
+                    structure = structure.view(batch_size, edge_size, edge_size, 64)
+            out = layer(out, structure, mask, relation_ids)
+        out = self.layer_norm(out)
+        return emb, out.transpose(0, 1).contiguous()
+
+
+class ScriptableDecoderLayer(nn.Module):
+    """ :obj:`onmt.transformer_decoder.TransformerDecoderLayer` for one step """
+
+    def __init__(self, layer):
+        super(ScriptableDecoderLayer, self).__init__()
+        self.self_attn = ScriptableAttention(layer.self_attn)
+        self.context_attn = ScriptableAttention(layer.context_attn)
+        self.feed_forward = layer.feed_forward
+        self.layer_norm_1 = layer.layer_norm_1
+        self.layer_norm_2 = layer.layer_norm_2
+
+    def forward(self, inputs: torch.Tensor, step: int, src_pad_mask: torch.Tensor,
+                memory_keys: torch.Tensor, memory_values: torch.Tensor,
+                self_keys: torch.Tensor, self_values: torch.Tensor) -> torch.Tensor:
+        input_norm = self.layer_norm_1(inputs)
+        key, value = self.self_attn.project(input_norm, input_norm)
+        self_keys[:, :, step:step + 1] = key
+        self_values[:, :, step:step + 1] = value
+        query = self.self_attn(input_norm, self_keys[:, :, :step + 1], self_values[:, :, :step + 1]) + inputs
+
+        mid = self.context_attn(self.layer_norm_2(query), memory_keys, memory_values, src_pad_mask)
+        return self.feed_forward(mid + query)
+
+
+class ScriptableDecoderStep(nn.Module):
+    """ :obj:`onmt.transformer_decoder.TransformerDecoder` for one step """
+
+    def __init__(self, decoder):
+        super(ScriptableDecoderStep, self).__init__()
+        self.embeddings = ScriptableEmbeddings(decoder.embeddings)
+        self.padding_idx = decoder.embeddings.word_padding_idx
+        self.transformer_layers = nn.ModuleList([ScriptableDecoderLayer(layer)
+                                                 for layer in decoder.transformer_layers])
+        self.layer_norm = decoder.layer_norm
+        self.num_layers = decoder.num_layers
+        self.head_count = decoder.transformer_layers[0].self_attn.head_count
+        self.dim_per_head = decoder.transformer_layers[0].self_attn.dim_per_head
+
+    @torch.jit.export
+    def memory(self, src: torch.Tensor, src_enc: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+        """
+        The source padding mask `[batch x 1 x src_len]` and the stacked
+        memory keys and values of the encoded `src`.
+        """
+        memory_bank = src_enc.transpose(0, 1).contiguous()
+        keys: List[torch.Tensor] = []
+        values: List[torch.Tensor] = []
+        for layer in self.transformer_layers:
+            key, value = layer.context_attn.project(memory_bank, memory_bank)
+            keys.append(key)
+            values.append(value)
+        src_pad_mask = src.transpose(0, 1).eq(self.padding_idx).unsqueeze(1)
+        return src_pad_mask, torch.stack(keys), torch.stack(values)
+
+    @torch.jit.export
+    def init_cache(self, n: int, max_length: int, src_enc: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
+        """ Empty self attention keys and values for `n` hypotheses """
+        size = [self.num_layers, n, self.head_count, max_length, self.dim_per_head]
+        return src_enc.new_empty(size), src_enc.new_empty(size)
+
+    def forward(self, tgt: torch.Tensor, step: int, src_pad_mask: torch.Tensor,
+                memory_keys: torch.Tensor, memory_values: torch.Tensor,
+                self_keys: torch.Tensor, self_values: torch.Tensor) -> torch.Tensor:
+        """
+        Decode the words `tgt` `[1 x n]` at position `step`, writing their
+        self attention keys and values into the cache. Returns the decoder
+        output `[1 x n x dim]`.
+        """
+        emb = self.embeddings(tgt, torch.full([1, 1], step, device=tgt.device))
+        output = emb.transpose(0, 1).contiguous()
+        for i, layer in enumerate(self.transformer_layers):
+            output = layer(output, step, src_pad_mask, memory_keys[i], memory_values[i],
+                           self_keys[i], self_values[i])
+        output = self.layer_norm(output)
+        return output.transpose(0, 1).contiguous()
+
+
+class ScriptableModel(nn.Module):
+    """ The encoder, decoder step and generator of an eval mode `model` """
+
+    def __init__(self, model):
+        super(ScriptableModel, self).__init__()
+        self.encoder = ScriptableEncoder(model.encoder)
+        self.decoder = ScriptableDecoderStep(model.decoder)
+        self.generator = model.generator
+
+
+def export_scripted(model, fields, path):
+    """ Script `model` and save it to `path` with the vocab of `fields` """
+    scripted = torch.jit.script(ScriptableModel(model).eval())
+    vocab = io.BytesIO()
+    torch.save(save_fields_to_vocab(fields), vocab)
+    torch.jit.save(scripted, path, _extra_files={'vocab.pt': vocab.getvalue()})
+
+
+def load_scripted_model(path, device):
+    """ The fields and the :obj:`ScriptedModel` of an archive of :obj:`export_scripted` """
+    extra_files = {'vocab.pt': ''}
+    module = torch.jit.load(path, map_location=device, _extra_files=extra_files)
+    vocab = torch.load(io.BytesIO(extra_files['vocab.pt']))
+    fields = load_fields_from_vocab(vocab, module.encoder.n_structures)
+    return fields, ScriptedModel(module)
+
+
+class ScriptedEncoder(object):
+    """ Call a scripted encoder like :obj:`TransformerEncoder` """
+
+    def __init__(self, module):
+        self.module = module
+        self.n_structures = module.n_structures
+
+    def __call__(self, src, structures, lengths=None, packing=None):
+        if packing is not None:
+            raise AssertionError("Scripted models do not support -pack_graphs")
+        emb, memory_bank = self.module(src, structures)
+        return emb, memory_bank, lengths
+
+
+class ScriptedDecoder(object):
+    """
+    Decode with a scripted decoder step like with :obj:`TransformerDecoder`.
+    The state is kept per thread, its cache as stacked tensors.
+    """
+
+    def __init__(self, module):
+        self.module = module
+        self.padding_idx = module.padding_idx
+        self._local = threading.local()
+
+    @property
+    def state(self):
+        """ Decoder state of the calling thread """
+        if not hasattr(self._local, 'state'):
+            self._local.state = {}
+        return self._local.state
+
+    def init_state(self, src, src_enc, max_length=None):
+        if max_length is None:
+            raise AssertionError("Scripted decoding needs the maximum length of its cache")
+        src_pad_mask, memory_keys, memory_values = self.module.memory(src, src_enc)
+        self.state.update(src=src, src_enc=src_enc, src_pad_mask=src_pad_mask,
+                          memory_keys=memory_keys, memory_values=memory_values,
+                          self_keys=None, self_values=None, max_length=max_length, cache_length=0)
+
+    def map_state(self, fn, memory_fn=None):
+        """
+        See :obj:`TransformerDecoder.map_state`. The stacked caches are
+        mapped layer by layer, as selecting along their second dimension
+        at once is much slower.
+        """
+        state = self.state
+        if memory_fn is not None:
+            src = memory_fn(state["src"], 1)
+            src_len = int(src.ne(self.padding_idx).sum(0).max())
+            state["src"] = src[:src_len]
+            state["src_pad_mask"] = memory_fn(state["src_pad_mask"][:, :, :src_len], 0)
+            for name in ("memory_keys", "memory_values"):
+                state[name] = torch.stack([memory_fn(v[:, :, :src_len], 0) for v in state[name]])
+        if state["self_keys"] is not None:
+            length = state["cache_length"]
+            for name in ("self_keys", "self_values"):
+                cache = mapped = state[name]
+                for i in range(cache.size(0)):
+                    # Only map the filled steps of the preallocated cache.
+                    filled = fn(cache[i, :, :, :length], 0)
+                    if filled.size(0) != mapped.size(1):
+                        mapped = cache.new_empty(cache.size(0), filled.size(0), *cache.size()[2:])
+                    mapped[i, :, :, :length] = filled
+                state[name] = mapped
+
+    def __call__(self, tgt, step):
+        state = self.state
+        if step == 0:
+            state["self_keys"], state["self_values"] = self.module.init_cache(
+                tgt.size(1), state["max_length"], state["src_enc"])
+        output = self.module(tgt, step, state["src_pad_mask"], state["memory_keys"], state["memory_values"],
+                             state["self_keys"], state["self_values"])
+        state["cache_length"] = step + 1
+        return output, None
+
+
+class ScriptedModel(object):
+    """ A scripted archive with the interface of :obj:`NMTModel` used for translation """
+
+    def __init__(self, module):
+        self.encoder = ScriptedEncoder(module.encoder)
+        self.decoder = ScriptedDecoder(module.decoder)
+        self.generator = module.generator
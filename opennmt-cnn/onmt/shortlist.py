@@ -0,0 +1,103 @@
+""" Target vocabulary shortlists, to decode a batch over the likely words of its sources only """
+import torch
+import torch.nn.functional as F
+
+import onmt.constants as Constants
+
+SPECIAL_WORDS = [Constants.UNK_WORD, Constants.PAD_WORD, Constants.BOS_WORD, Constants.EOS_WORD]
+
+
+def build_shortlist(datasets, src_vocab, tgt_vocab, n_lexical=50, n_frequent=1000):
+    """
+    Count in the training `datasets` in how many sentences each source
+    word, target word and pair of them occur, and build the shortlist
+    table of the vocabularies:
+
+    * `lexical` `[src_vocab x 1 + n_lexical]`: for every source word, the
+      target word spelled the same, then the `n_lexical` target words of
+      highest Dice coefficient with it, -1 where there are none
+    * `frequent` `[n_frequent]`: the most frequent target words
+    """
+    n_src, n_tgt = len(src_vocab), len(tgt_vocab)
+    src_unk, tgt_unk = src_vocab.stoi[Constants.UNK_WORD], tgt_vocab.stoi[Constants.UNK_WORD]
+    src_counts = torch.zeros(n_src, dtype=torch.long)
+    tgt_counts = torch.zeros(n_tgt, dtype=torch.long)
+    tgt_freqs = torch.zeros(n_tgt, dtype=torch.long)
+    # Every pair seen so far as `src * n_tgt + tgt`, and its count.
+    pairs = torch.zeros(0, dtype=torch.long)
+    pair_counts = torch.zeros(0, dtype=torch.long)
+
+    for dataset in datasets:
+        keys = [pairs]
+        for ex in dataset.examples:
+            src = torch.tensor([src_vocab.stoi.get(w, src_unk) for w in ex.src], dtype=torch.long).unique()
+            tgt_words = torch.tensor([tgt_vocab.stoi.get(w, tgt_unk) for w in ex.tgt], dtype=torch.long)
+            tgt = tgt_words.unique()
+            src_counts[src] += 1
+            tgt_counts[tgt] += 1
+            tgt_freqs.index_add_(0, tgt_words, torch.ones_like(tgt_words))
+            keys.append((src.unsqueeze(1) * n_tgt + tgt).view(-1))
+        keys = torch.cat(keys)
+        weights = torch.cat((pair_counts, torch.ones(keys.size(0) - pairs.size(0), dtype=torch.long)))
+        pairs, inverse = torch.unique(keys, return_inverse=True)
+        pair_counts = torch.zeros_like(pairs).index_add_(0, inverse, weights)
+
+    src_ids, tgt_ids = pairs // n_tgt, pairs % n_tgt
+    dice = 2. * pair_counts.float() / (src_counts[src_ids] + tgt_counts[tgt_ids]).float()
+    # Order the pairs by source word, then by decreasing Dice, and keep the
+    # first n_lexical of every source word.
+    order = dice.sort(descending=True, stable=True)[1]
+    order = order[src_ids[order].sort(stable=True)[1]]
+    src_ids, tgt_ids = src_ids[order], tgt_ids[order]
+    group_sizes = torch.bincount(src_ids, minlength=n_src)
+    rank = torch.arange(src_ids.size(0)) - (group_sizes.cumsum(0) - group_sizes)[src_ids]
+    keep = rank < n_lexical
+
+    lexical = torch.full((n_src, 1 + n_lexical), -1, dtype=torch.long)
+    lexical[src_ids[keep], 1 + rank[keep]] = tgt_ids[keep]
+    for i, word in enumerate(src_vocab.itos):
+        if word in tgt_vocab.stoi and word not in SPECIAL_WORDS:
+            lexical[i, 0] = tgt_vocab.stoi[word]
+    frequent = tgt_freqs.topk(min(n_frequent, n_tgt))[1]
+    return {'lexical': lexical, 'frequent': frequent, 'tgt_vocab_size': n_tgt}
+
+
+class Shortlist(object):
+    """
+    Decode a batch over its candidate target words only: those of its
+    source words in the `lexical` table, the `frequent` ones and the
+    special words. See :obj:`build_shortlist`.
+    """
+
+    def __init__(self, table, fields, device):
+        if table['lexical'].size(0) != len(fields['src'].vocab) or \
+                table['tgt_vocab_size'] != len(fields['tgt'].vocab):
+            raise AssertionError("The shortlist was built for other vocabularies than the model's")
+        tgt_vocab = fields['tgt'].vocab
+        self.lexical = table['lexical'].to(device)
+        self.frequent = table['frequent'].to(device)
+        self.special = torch.tensor([tgt_vocab.stoi[w] for w in SPECIAL_WORDS if w != Constants.PAD_WORD],
+                                    dtype=torch.long, device=device)
+
+    @classmethod
+    def load(cls, path, fields, device):
+        return cls(torch.load(path), fields, device)
+
+    def candidates(self, src):
+        """ The sorted target ids `[n]` to decode the batch `src` `[src_len x batch]` over """
+        ids = torch.cat((self.special, self.frequent, self.lexical[src.view(-1)].view(-1)))
+        return torch.unique(ids[ids.ge(0)])
+
+    @staticmethod
+    def generator(generator, vocab_ids):
+        """
+        `generator` (Linear and LogSoftmax) restricted to the target words
+        `vocab_ids`, its outputs are indexes in `vocab_ids`.
+        """
+        linear = next(generator.children())
+        weight, bias = linear.weight, linear.bias
+        if callable(weight):
+            # Dynamically quantized
+            weight, bias = weight().dequantize(), bias()
+        weight, bias = weight.index_select(0, vocab_ids), bias.index_select(0, vocab_ids)
+        return lambda x: torch.log_softmax(F.linear(x, weight, bias), -1)
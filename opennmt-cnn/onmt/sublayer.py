@@ -3,6 +3,7 @@ import math
 
 import torch
 import torch.nn as nn
+from torch.utils.checkpoint import checkpoint
 
 
 # from onmt.utils.misc import aeq
@@ -23,9 +24,16 @@ class MultiHeadedAttention(nn.Module):
        model_dim (int): the dimension of keys/values/queries,
            must be divisible by head_count
        dropout (float): dropout parameter
+       max_memory (float): memory budget in MB for the scores and structure
+           activations, the queries are attended in blocks of rows to stay
+           within it. 0 attends all queries at once.
+
+    The module keeps no state between calls other than the `layer_cache`
+    passed by the caller, so in eval mode one instance can be called from
+    several threads at once, as long as each thread has its own cache.
     """
 
-    def __init__(self, head_count, model_dim, dropout=0.1):
+    def __init__(self, head_count, model_dim, dropout=0.1, max_memory=0):
         assert model_dim % head_count == 0
         self.dim_per_head = model_dim // head_count
         self.model_dim = model_dim
@@ -44,9 +52,10 @@ class MultiHeadedAttention(nn.Module):
         self.softmax = nn.Softmax(dim=-1)
         self.dropout = nn.Dropout(dropout)
         self.final_linear = nn.Linear(model_dim, model_dim)
+        self.max_memory = max_memory
 
     def forward(self, key, value, query, structure=None, mask=None,
-                layer_cache=None, type=None):
+                layer_cache=None, type=None, relation_ids=None, step=None):
         """
         Compute the context vector and the attention vectors.
 
@@ -56,20 +65,32 @@ class MultiHeadedAttention(nn.Module):
            value (`FloatTensor`): set of `key_len`
                 value vectors `[batch, key_len, dim]`
            query (`FloatTensor`): set of `query_len`
-                 query vectors  `[batch, query_len, dim]`
+                 query vectors  `[batch, query_len, dim]`, or
+                 `[batch * n, query_len, dim]` for n queries of every batch
+                 entry next to each other, e.g. the hypotheses of a beam
+                 attending the memory of their sentence
            mask: binary mask indicating which keys have
                  non-zero attention `[batch, query_len, key_len]`
+           structure (`FloatTensor`): structure vector of every query/key
+                 pair `[batch, query_len, key_len, 64]`, or with
+                 `relation_ids` the relation table `[n_relations, 64]`
+           relation_ids (`LongTensor`): the relation of every query/key
+                 pair in the `structure` table `[batch, query_len, key_len]`
+           step (int): position of the query in the self attention cache
         Returns:
            (`FloatTensor`, `FloatTensor`) :
 
            * output context vectors `[batch, query_len, dim]`
            * one of the attention vectors `[batch, query_len, key_len]`
         """
-        global structure_k, structure_v
-
         batch_size = key.size(0)
         dim_per_head = self.dim_per_head
         head_count = self.head_count
+
+        # The n queries of a batch entry are attended as n times more rows.
+        query_batch = query.size(0)
+        if query_batch != batch_size:
+            query = query.contiguous().view(batch_size, -1, query.size(-1))
         key_len = key.size(1)
         query_len = query.size(1)
 
@@ -88,27 +109,12 @@ class MultiHeadedAttention(nn.Module):
                                     self.linear_keys(query), \
                                     self.linear_values(query)
 
-                if structure is not None:
-                    structure_k, structure_v = self.linear_structure_k(structure), \
-                                               self.linear_structure_v(structure)
-                else:
-                    structure_k = None
-                    structure_v = None
                 key = shape(key)
                 value = shape(value)
 
                 if layer_cache is not None:
-                    device = key.device
-                    if layer_cache["self_keys"] is not None:
-                        key = torch.cat(
-                            (layer_cache["self_keys"].to(device), key),
-                            dim=2)
-                    if layer_cache["self_values"] is not None:
-                        value = torch.cat(
-                            (layer_cache["self_values"].to(device), value),
-                            dim=2)
-                    layer_cache["self_keys"] = key
-                    layer_cache["self_values"] = value
+                    key = self._write_cache(layer_cache, "self_keys", key, step)
+                    value = self._write_cache(layer_cache, "self_values", value, step)
             elif type == "context":
                 query = self.linear_query(query)
                 if layer_cache is not None:
@@ -132,12 +138,6 @@ class MultiHeadedAttention(nn.Module):
             value = self.linear_values(value)
             query = self.linear_query(query)
 
-            if structure is not None:
-                structure_k, structure_v = self.linear_structure_k(structure), \
-                                           self.linear_structure_v(structure)
-            else:
-                structure_k = None
-                structure_v = None
             key = shape(key)
             value = shape(value)
 
@@ -146,17 +146,119 @@ class MultiHeadedAttention(nn.Module):
         key_len = key.size(2)
         query_len = query.size(2)
 
-        # 2) Calculate and scale scores.
+        # 2) Scale the queries, and attend in blocks of query rows if the
+        #    activations of all of them would not fit in the memory budget.
         query = query / math.sqrt(dim_per_head)
+        if structure is not None and relation_ids is not None:
+            relation_ids = relation_ids.unsqueeze(1).expand(-1, head_count, -1, -1)
+        chunk_size = self._query_chunk_size(query, key_len, structure, relation_ids)
+
+        # When training in blocks, each block is recomputed in the backward
+        # pass instead of keeping its activations.
+        recompute = chunk_size < query_len and self.training and torch.is_grad_enabled()
+
+        contexts, top_attns = [], []
+        for start in range(0, query_len, chunk_size):
+            rows = slice(start, start + chunk_size)
+            chunk_structure, chunk_relation_ids, chunk_mask = structure, None, mask
+            if relation_ids is not None:
+                chunk_relation_ids = relation_ids[:, :, rows]
+            elif structure is not None:
+                chunk_structure = structure[:, rows]
+            if mask is not None and mask.size(1) > 1:
+                chunk_mask = mask[:, rows]
+            if recompute:
+                context, attn = checkpoint(self._attend, query[:, :, rows], key, value, chunk_structure,
+                                           chunk_relation_ids, chunk_mask, use_reentrant=False)
+            else:
+                context, attn = self._attend(query[:, :, rows], key, value, chunk_structure,
+                                             chunk_relation_ids, chunk_mask)
+            contexts.append(context)
+            top_attns.append(attn[:, 0].contiguous())
+        if len(contexts) > 1:
+            context = torch.cat(contexts, 2)
+            top_attn = torch.cat(top_attns, 1)
+        else:
+            context, top_attn = contexts[0], top_attns[0]
+
+        context = unshape(context)
+        output = self.final_linear(context)
+        if query_batch != batch_size:
+            output = output.view(query_batch, -1, output.size(-1))
+            top_attn = top_attn.view(query_batch, -1, top_attn.size(-1))
+
+        # Return one attn
+        return output, top_attn
+
+    @staticmethod
+    def _write_cache(layer_cache, name, x, step):
+        """
+        Write the keys or values `x` of positions `step..` in place into the
+        preallocated cache `layer_cache[name]` `[batch, head, max_len, dim]`,
+        growing it if needed, and return a view of the filled positions.
+        """
+        cache = layer_cache[name]
+        end = step + x.size(2)
+        if cache is None or cache.size(2) < end:
+            capacity = end if cache is None else max(end, 2 * cache.size(2))
+            grown = x.new_empty(x.size(0), x.size(1), capacity, x.size(3))
+            if cache is not None:
+                grown[:, :, :step] = cache[:, :, :step]
+            cache = layer_cache[name] = grown
+        cache[:, :, step:end] = x
+        return cache[:, :, :end]
+
+    def _query_chunk_size(self, query, key_len, structure, relation_ids):
+        """
+        The number of query rows attended at once so that their scores,
+        attention and structure keys/values stay within `max_memory`.
+        """
+        batch_size, head_count, query_len, _ = query.size()
+        if self.max_memory <= 0:
+            return query_len
+
+        # Elements built for one query row: the scores, the attention and
+        # its dropout, plus the structure keys, values and scores.
+        row_size = 3 * batch_size * head_count * key_len
+        if relation_ids is not None:
+            row_size += 2 * batch_size * head_count * structure.size(0)
+        elif structure is not None:
+            row_size += batch_size * key_len * (2 * structure.size(-1) + head_count)
+        max_elements = self.max_memory * 2 ** 20 // query.element_size()
+        return int(max(1, min(query_len, max_elements // row_size)))
+
+    def _attend(self, query, key, value, structure=None, relation_ids=None, mask=None):
+        """
+        Attend a block of scaled queries `[batch, heads, query_len, dim]` over
+        all keys. `structure`, `relation_ids` and `mask` hold the rows of
+        these queries only.
+
+        Returns:
+           (`FloatTensor`, `FloatTensor`) :
+
+           * context vectors `[batch, heads, query_len, dim]`
+           * attention `[batch, heads, query_len, key_len]`
+        """
+        batch_size, head_count, query_len, _ = query.size()
+
+        # 2) Calculate scores.
         scores = torch.matmul(query, key.transpose(2, 3))
 
-        if structure_k is not None:
+        structure_k = structure_v = None
+        if structure is not None:
+            structure_k, structure_v = self.linear_structure_k(structure), \
+                                       self.linear_structure_v(structure)
+
+        if structure_k is not None and relation_ids is not None:
+            # Score every query against the relation table once, and pick
+            # the score of each pair by its relation id.
+            scores_k = torch.matmul(query, structure_k.t())  # [B, h, T_q, R]
+            scores = scores + scores_k.gather(3, relation_ids)
+        elif structure_k is not None:
             q = query.transpose(1, 2)
 
-            # print(q.size(), structure_k.transpose(2,3).size())
             scores_k = torch.matmul(q, structure_k.transpose(2, 3))
             scores_k = scores_k.transpose(1, 2)
-            # print (scores.size(),scores_k.size())
             scores = scores + scores_k
         if mask is not None:
             mask = mask.unsqueeze(1)  # [B, 1, 1, T_values]
@@ -166,22 +268,19 @@ class MultiHeadedAttention(nn.Module):
         attn = self.softmax(scores)
         drop_attn = self.dropout(attn)
         context = torch.matmul(drop_attn, value)
-        if structure_v is not None:
+        if structure_v is not None and relation_ids is not None:
+            # Sum the attention of the pairs sharing a relation, then weight
+            # the relation table with it.
+            relation_attn = drop_attn.new_zeros(batch_size, head_count, query_len, structure_v.size(0))
+            relation_attn.scatter_add_(3, relation_ids, drop_attn)
+            context = context + torch.matmul(relation_attn, structure_v)
+        elif structure_v is not None:
             drop_attn_v = drop_attn.transpose(1, 2)
             context_v = torch.matmul(drop_attn_v, structure_v)
             context_v = context_v.transpose(1, 2)
-            # print(context.size(),context_v.size())
             context = context + context_v
-        context = unshape(context)
-        output = self.final_linear(context)
 
-        # Return one attn
-        top_attn = attn \
-                       .view(batch_size, head_count,
-                             query_len, key_len)[:, 0, :, :] \
-            .contiguous()
-
-        return output, top_attn
+        return context, attn
 
 
 class PositionwiseFeedForward(nn.Module):
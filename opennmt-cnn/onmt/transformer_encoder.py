@@ -18,53 +18,69 @@ class TransformerEncoderLayer(nn.Module):
             heads (int): the number of head for MultiHeadedAttention.
             d_ff (int): the second-layer of the PositionwiseFeedForward.
             dropout (float): dropout probability(0-1.0).
+            n_structures (int): the number of structure channels.
+            encode_structure (bool): whether the layer has its own structure
+                       encoder, see :obj:`encode_structure`.
+            max_memory (float): memory budget of self attention in MB.
     """
 
-    def __init__(self, d_model, heads, d_ff, dropout):
+    def __init__(self, d_model, heads, d_ff, dropout, n_structures, encode_structure=True, max_memory=0):
         super(TransformerEncoderLayer, self).__init__()
-        self.self_attn = onmt.sublayer.MultiHeadedAttention(heads, d_model, dropout=dropout)
+        self.self_attn = onmt.sublayer.MultiHeadedAttention(heads, d_model, dropout=dropout, max_memory=max_memory)
 
-        self.cnn = nn.Conv1d(64, 64, 4)
+        if encode_structure:
+            self.cnn = nn.Conv1d(64, 64, n_structures)
+        self.n_structures = n_structures
 
         self.feed_forward = PositionwiseFeedForward(d_model, d_ff,
                                                     dropout)  # d_ff (int): the hidden layer size of the second-layer of the FNN.
         self.att_layer_norm = nn.LayerNorm(d_model, eps=1e-6)
         self.ffn_layer_norm = nn.LayerNorm(d_model, eps=1e-6)  # FeedForwardnorm
-        self.structure_layer_norm = nn.LayerNorm(64, eps=1e-6)
+        if encode_structure:
+            self.structure_layer_norm = nn.LayerNorm(64, eps=1e-6)
         self.dropout = nn.Dropout(dropout)
 
         # self.weight_1 = torch.nn.Parameter(torch.Tensor(), requires_grad=True)   # 增加可学习参数
         # self.weight_1.data.fill_(0.25)
 
-    def forward(self, inputs, structure, mask):
+    def encode_structure(self, paths):
+        """
+               Encode the embedded labels along each path into one
+               structure vector per path.
+
+               Args:
+                   paths (`FloatTensor`): `[n_paths x n_structures x 64]`
+               Returns:
+                   (`FloatTensor`): `[n_paths x 64]`
+        """
+        structure = paths.transpose(1, 2).contiguous()  # -1, 64, n_structures
+        structure = self.cnn(structure)  # -1, 64, 1
+        structure = torch.relu(structure)
+        structure = self.dropout(structure)
+        output_structures = structure.view(-1, 64)
+        output_structures = self.structure_layer_norm(output_structures)
+        return output_structures
+
+    def forward(self, inputs, structure, mask, relation_ids=None):
         """
                Transformer Encoder Layer definition.
 
                Args:
                    inputs (`FloatTensor`): `[batch_size x src_len x model_dim]`  146 * 12 * 512
                    mask (`LongTensor`): `[batch_size x src_len x src_len]`
-                   structure: 144 * 5 * 146 * 64
+                   structure (`FloatTensor`): the encoded structure
+                       `[batch_size x src_len x src_len x 64]`, or with
+                       `relation_ids` the encoded paths `[n_paths x 64]`
+                   relation_ids (`LongTensor`): the path of every concept
+                       pair `[batch_size x src_len x src_len]`
                Returns:
                    (`FloatTensor`):
 
                    * outputs `[batch_size * src_len * model_dim]`
         """
         input_norm = self.att_layer_norm(inputs)
-
-        structure = structure.transpose(0, 1).contiguous()
-        structure = structure.transpose(0, 2).contiguous()  # structuer  batch_size * 144 * 5 * 64
-        batch_size = structure.size(0)
-        edge_size = structure.size(1) ** 0.5
-        edge_size = int(edge_size)
-        structure = structure.view(-1, 4, 64).contiguous()
-        structure = structure.transpose(1, 2).contiguous()  # -1, 64, 4
-        structure = self.cnn(structure)  # -1, 64, 1
-        structure = torch.relu(structure)
-        structure = self.dropout(structure)
-        output_structures = structure.view(batch_size, edge_size, edge_size, 64)
-        output_structures = self.structure_layer_norm(output_structures)
-        outputs, _ = self.self_attn(input_norm, input_norm, input_norm, structure=output_structures,
-                                    mask=mask)  # structure 146 * 12 * 12 * 64
+        outputs, _ = self.self_attn(input_norm, input_norm, input_norm, structure=structure,
+                                    mask=mask, relation_ids=relation_ids)  # structure 146 * 12 * 12 * 64
         inputs = self.dropout(outputs) + inputs
         input_norm = self.ffn_layer_norm(inputs)
         outputs = self.feed_forward(input_norm)
@@ -74,16 +90,34 @@ class TransformerEncoderLayer(nn.Module):
 
 class TransformerEncoder(nn.Module):
 
-    def __init__(self, num_layers, d_model, heads, d_ff, dropout, embeddings, structure_embeddings):
+    def __init__(self, num_layers, d_model, heads, d_ff, dropout, embeddings, structure_embeddings, n_structures,
+                 structure_encoder='per_layer', structure_paths='all', structure_attention='dense',
+                 max_memory=0):
         super(TransformerEncoder, self).__init__()
 
         self.num_layers = num_layers
         self.embeddings = embeddings
         self.structure_embeddings = structure_embeddings
+        # The number of structure channels (labels along a path) consumed.
+        self.n_structures = n_structures
+        # 'per_layer': every layer encodes the structure itself,
+        # 'shared': the first layer encodes it once for all of them.
+        self.structure_encoder = structure_encoder
+        # 'all': every concept pair is encoded, 'unique': only the distinct
+        # label paths of the batch are, and pairs gather their result.
+        self.structure_paths = structure_paths
+        # 'dense': attention gets a structure vector per pair, 'index': it
+        # gets the encoded paths and the path id of every pair.
+        if structure_attention == 'index' and structure_paths != 'unique':
+            raise AssertionError("-structure_attention index requires -structure_paths unique")
+        self.structure_attention = structure_attention
 
         # Bulid Encode
         self.transformer = nn.ModuleList(
-            [TransformerEncoderLayer(d_model, heads, d_ff, dropout) for _ in range(num_layers)])
+            [TransformerEncoderLayer(d_model, heads, d_ff, dropout, n_structures,
+                                     encode_structure=(structure_encoder == 'per_layer' or i == 0),
+                                     max_memory=max_memory)
+             for i in range(num_layers)])
         self.layer_norm = nn.LayerNorm(d_model, eps=1e-6)
 
     def _check_args(self, src, lengths=None):
@@ -92,39 +126,71 @@ class TransformerEncoder(nn.Module):
             n_batch_, = lengths.size()
             aeq(n_batch, n_batch_)
 
-    def forward(self, src, structure1, structure2, structure3, structure4, structure5, lengths=None):
-        """ See :obj:`EncoderBase.forward()`"""
-        # self._check_args(src, lengths)
+    def forward(self, src, structures, lengths=None, packing=None):
+        """ See :obj:`EncoderBase.forward()`
 
-        emb = self.embeddings(src)
-        assert emb.dim() == 3  # len * batch * embedding_dim
+        With `packing` (:obj:`inputters.dataset.GraphPacking`) the graphs are
+        encoded packed into its rows, and the outputs are unpacked back to the
+        layout of `src`.
+        """
+        # self._check_args(src, lengths)
+        assert len(structures) == self.n_structures
 
-        structure_emb1 = self.structure_embeddings(structure1, 0)  # 12 * 12 * batch * embedding_dim(64)
-        structure_emb2 = self.structure_embeddings(structure2, 1)
-        structure_emb3 = self.structure_embeddings(structure3, 2)
-        structure_emb4 = self.structure_embeddings(structure4, 3)
-        # structure_emb5 = self.structure_embeddings(structure5, 4)
-        assert structure_emb1.dim() == 4 and structure_emb2.dim() == 4 and structure_emb3.dim() == 4 and structure_emb4.dim() == 4
+        positions = None
+        if packing is not None:
+            src, structures, positions = packing.src, packing.structures, packing.positions
 
-        batch_size = structure_emb1.size(2)  # batch的大小
+        emb = self.embeddings(src, step=positions)
+        assert emb.dim() == 3  # len * batch * embedding_dim
 
-        structure_emb1 = structure_emb1.view(-1, 1, batch_size,
-                                             64).contiguous()  # -1 * 1 * batch * 64        [144, 1, 146, 64]
-        structure_emb2 = structure_emb2.view(-1, 1, batch_size, 64).contiguous()
-        structure_emb3 = structure_emb3.view(-1, 1, batch_size, 64).contiguous()
-        structure_emb4 = structure_emb4.view(-1, 1, batch_size, 64).contiguous()
-        # structure_emb5 = structure_emb5.view(-1, 1, batch_size, 64).contiguous()
-        # 144 * 5 * 146 * 64
-        output_structure = torch.cat((structure_emb1, structure_emb2, structure_emb3, structure_emb4), 1)
+        edge_size, _, batch_size = structures[0].size()
+        path_index = None
+        if self.structure_paths == 'unique':
+            # Pairs with the same labels along their path share the structure
+            # vector, so only the distinct paths of the batch are encoded.
+            paths = torch.stack(structures, -1).permute(2, 0, 1, 3)  # batch * 12 * 12 * n_structures
+            paths, path_index = torch.unique(paths.reshape(-1, self.n_structures), dim=0, return_inverse=True)
+            # n_paths * n_structures * 64, the channel index is the position
+            output_structure = torch.stack([self.structure_embeddings(paths[:, i], i)
+                                            for i in range(self.n_structures)], 1)
+        else:
+            structure_embs = []
+            for i, structure in enumerate(structures):
+                # 12 * 12 * batch * embedding_dim(64), the channel index is the position
+                structure_emb = self.structure_embeddings(structure, i)
+                assert structure_emb.dim() == 4
+                # -1 * 1 * batch * 64        [144, 1, 146, 64]
+                structure_embs.append(structure_emb.view(-1, 1, batch_size, 64).contiguous())
+            # 144 * n_structures * 146 * 64
+            output_structure = torch.cat(structure_embs, 1)
+            output_structure = output_structure.transpose(0, 1).contiguous()
+            output_structure = output_structure.transpose(0, 2).contiguous()  # 146 * 144 * n_structures * 64
+            output_structure = output_structure.view(-1, self.n_structures, 64)
 
         out = emb.transpose(0, 1).contiguous()  # 146 * 12 * 512
 
-        words = src.transpose(0, 1)
-        padding_idx = self.embeddings.word_padding_idx
-        mask = words.data.eq(padding_idx).unsqueeze(1)  # [B, 1, T]
+        if packing is not None:
+            mask = packing.mask  # [B, T, T], block diagonal
+        else:
+            words = src.transpose(0, 1)
+            padding_idx = self.embeddings.word_padding_idx
+            mask = words.data.eq(padding_idx).unsqueeze(1)  # [B, 1, T]
         # Run the forward pass of every layer of the tranformer.
         for i in range(self.num_layers):
-            out = self.transformer[i](out, output_structure, mask)
+            if self.structure_encoder == 'per_layer' or i == 0:
+                structure = self.transformer[i].encode_structure(output_structure)
+                if self.structure_attention == 'index':
+                    relation_ids = path_index.view(batch_size, edge_size, edge_size)
+                else:
+                    relation_ids = None
+                    if path_index is not None:
+                        structure = structure.index_select(0, path_index.view(-1))
+                    structure = structure.view(batch_size, edge_size, edge_size, 64)
+            out = self.transformer[i](out, structure, mask, relation_ids)
         out = self.layer_norm(out)
 
+        if packing is not None:
+            emb = packing.unpack(emb.transpose(0, 1)).transpose(0, 1)
+            out = packing.unpack(out)
+
         return emb, out.transpose(0, 1).contiguous(), lengths
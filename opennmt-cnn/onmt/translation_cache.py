@@ -0,0 +1,159 @@
+""" LRU caches of the translations and the encoder outputs of repeated inputs """
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+
+import torch
+
+from utils.logging import logger
+
+
+class LRUCache(object):
+    """ At most `max_size` values, the least recently used one is dropped first """
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._values = OrderedDict()
+
+    def __len__(self):
+        return len(self._values)
+
+    def get(self, key):
+        value = self._values.get(key)
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+            self._values.move_to_end(key)
+        return value
+
+    def put(self, key, value):
+        if self.max_size <= 0:
+            return
+        self._values[key] = value
+        self._values.move_to_end(key)
+        while len(self._values) > self.max_size:
+            self._values.popitem(last=False)
+
+    def items(self):
+        return list(self._values.items())
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {'size': len(self), 'hits': self.hits, 'misses': self.misses,
+                'hit_rate': round(float(self.hits) / lookups, 3) if lookups else 0.}
+
+
+class TranslationCache(object):
+    """
+    Two levels of LRU cache for inputs that repeat: the translations, keyed
+    by the concepts, the structure paths and the decoding options, and the
+    encoder outputs, keyed by the numericalized concepts and structures
+    only, reused when the decoding options differ.
+
+    Args:
+        max_translations (int): translations kept
+        max_encodings (int): encoder outputs kept, `[len x hidden]` each
+        signature: the model and its options, a cache saved for another
+            signature is not loaded
+    """
+
+    def __init__(self, max_translations, max_encodings, signature):
+        self.translations = LRUCache(max_translations)
+        self.encodings = LRUCache(max_encodings)
+        self.signature = signature
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def translation_key(example, n_structures, decode_options):
+        """ Hash of the concepts and structure paths of `example`, and of `decode_options` """
+        h = hashlib.sha1(repr(decode_options).encode('utf-8'))
+        h.update(' '.join(example.src).encode('utf-8'))
+        for i in range(n_structures):
+            h.update(b'\n')
+            h.update(' '.join(' '.join(row) for row in getattr(example, 'structure%d' % (i + 1))).encode('utf-8'))
+        return h.hexdigest()
+
+    @staticmethod
+    def encoder_keys(src, structures, lengths):
+        """ Hashes of the sentences of a batch, `src` `[len x batch]` and `structures` `[len x len x batch]` """
+        src, structures, lengths = src.cpu(), [s.cpu() for s in structures], lengths.tolist()
+        keys = []
+        for i, length in enumerate(lengths):
+            h = hashlib.sha1(src[:length, i].numpy().tobytes())
+            for structure in structures:
+                h.update(structure[:length, :length, i].contiguous().numpy().tobytes())
+            keys.append(h.hexdigest())
+        return keys
+
+    def lookup_translations(self, keys):
+        """
+        The cached translations of `keys` by key. A key repeated in `keys`
+        counts as a hit after its first lookup, as it is translated once.
+        """
+        found, missed = {}, set()
+        with self.lock:
+            for key in keys:
+                if key in found or key in missed:
+                    self.translations.hits += 1
+                    continue
+                translation = self.translations.get(key)
+                if translation is None:
+                    missed.add(key)
+                else:
+                    found[key] = translation
+        return found
+
+    def put_translation(self, key, translation):
+        with self.lock:
+            self.translations.put(key, translation)
+
+    def lookup_encodings(self, keys):
+        """
+        The cached encoder output of every key of `keys`, or None. A key
+        repeated in `keys` counts as a hit after its first lookup, as it is
+        encoded once.
+        """
+        encodings, found = [], {}
+        with self.lock:
+            for key in keys:
+                if key in found:
+                    self.encodings.hits += 1
+                else:
+                    found[key] = self.encodings.get(key)
+                encodings.append(found[key])
+        return encodings
+
+    def put_encoding(self, key, src_enc):
+        with self.lock:
+            self.encodings.put(key, src_enc)
+
+    def stats(self):
+        with self.lock:
+            return {'translations': self.translations.stats(), 'encodings': self.encodings.stats()}
+
+    def load(self, path):
+        """ Add the entries of the cache saved at `path` if it was built with the same signature """
+        saved = torch.load(path, map_location='cpu', weights_only=True)
+        if saved['signature'] != self.signature:
+            logger.warning("Not loading the cache %s, it was built for another model or options" % path)
+            return
+        with self.lock:
+            for key, translation in saved['translations']:
+                self.translations.put(key, translation)
+            for key, src_enc in saved['encodings']:
+                self.encodings.put(key, src_enc)
+        logger.info("Loaded %d translations and %d encoder outputs from the cache %s"
+                    % (len(saved['translations']), len(saved['encodings']), path))
+
+    def save(self, path):
+        with self.lock:
+            saved = {'signature': self.signature,
+                     'translations': self.translations.items(),
+                     'encodings': [(key, src_enc.cpu()) for key, src_enc in self.encodings.items()]}
+        # Written aside and moved, so an interrupted save leaves the last cache.
+        torch.save(saved, path + '.tmp')
+        os.replace(path + '.tmp', path)
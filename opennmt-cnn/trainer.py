@@ -9,7 +9,7 @@
           users of this library) for the strategy things we do.
 """
 
-from inputters.dataset import make_features
+from inputters.dataset import make_features, make_structure_features, pack_graphs
 from utils.distributed import all_gather_list, all_reduce_and_rescale_tensors
 from utils.logging import logger
 from utils.loss import build_loss_compute
@@ -52,7 +52,7 @@ def build_trainer(opt, device_id, model, fields,
                       shard_size, norm_method,
                       grad_accum_count, n_gpu, gpu_rank,
                       gpu_verbose_level, report_manager,
-                      model_saver=model_saver)
+                      model_saver=model_saver, pack_graphs=opt.pack_graphs)
     return trainer
 
 
@@ -78,12 +78,15 @@ class Trainer(object):
         model_saver(:obj:`onmt.models.ModelSaverBase`): the saver is
             used to save a checkpoint.
             Thus nothing will be saved if this parameter is None
+        pack_graphs(bool): pack the small graphs of a batch into shared
+            rows before encoding them.
     """
 
     def __init__(self, model, train_loss, valid_loss, optim,
                  trunc_size=0, shard_size=32,
                  norm_method="sents", grad_accum_count=1, n_gpu=1, gpu_rank=1,
-                 gpu_verbose_level=0, report_manager=None, model_saver=None):
+                 gpu_verbose_level=0, report_manager=None, model_saver=None,
+                 pack_graphs=False):
         # Basic attributes.
         self.model = model
         self.train_loss = train_loss
@@ -98,6 +101,7 @@ class Trainer(object):
         self.gpu_verbose_level = gpu_verbose_level
         self.report_manager = report_manager
         self.model_saver = model_saver
+        self.pack_graphs = pack_graphs
 
         assert grad_accum_count > 0
         if grad_accum_count > 1:
@@ -108,7 +112,8 @@ class Trainer(object):
         # Set model in training mode.
         self.model.train()
 
-    def train(self, train_iter_fct, valid_iter_fct, train_steps, valid_steps):
+    def train(self, train_iter_fct, valid_iter_fct, train_steps, valid_steps,
+              train_iter_state=None):
         """
         The main training loops.
         by iterating over training data (i.e. `train_iter_fct`)
@@ -117,11 +122,13 @@ class Trainer(object):
         Args:
             train_iter_fct(function): a function that returns the train
                 iterator. e.g. something like
-                train_iter_fct = lambda: generator(*args, **kwargs)
+                train_iter_fct = lambda iter_state=None: generator(*args, **kwargs)
             valid_iter_fct(function): same as train_iter_fct, for valid data
             train_steps(int):
             valid_steps(int):
             save_checkpoint_steps(int):
+            train_iter_state(dict): iterator position saved in a checkpoint,
+                the first epoch resumes from there.
     
         Return:
             None
@@ -132,7 +139,7 @@ class Trainer(object):
         true_batchs = []
         accum = 0
         normalization = 0
-        train_iter = train_iter_fct()
+        train_iter = train_iter_fct(train_iter_state)
 
         total_stats = Statistics()
         report_stats = Statistics()
@@ -195,7 +202,7 @@ class Trainer(object):
                                               step, valid_stats=valid_stats)
 
                         if self.gpu_rank == 0:
-                            self._maybe_save(step)
+                            self._maybe_save(step, train_iter)
                         step += 1
                         if step > train_steps:
                             break
@@ -223,41 +230,11 @@ class Trainer(object):
 
             tgt = make_features(batch, 'tgt')
 
-            structure1 = make_features(batch, 'structure1')
-            structure1 = structure1.transpose(0, 1)
-            structure1 = structure1.transpose(1, 2)
-
-            structure2 = make_features(batch, 'structure2')
-            structure2 = structure2.transpose(0, 1)
-            structure2 = structure2.transpose(1, 2)
-
-            structure3 = make_features(batch, 'structure3')
-            structure3 = structure3.transpose(0, 1)
-            structure3 = structure3.transpose(1, 2)
-
-            structure4 = make_features(batch, 'structure4')
-            structure4 = structure4.transpose(0, 1)
-            structure4 = structure4.transpose(1, 2)
-
-            structure5 = make_features(batch, 'structure5')
-            structure5 = structure5.transpose(0, 1)
-            structure5 = structure5.transpose(1, 2)
-
-            # structure6 = make_features(batch, 'structure6')
-            # structure6 = structure6.transpose(0, 1)
-            # structure6 = structure6.transpose(1, 2)
-            #
-            # structure7 = make_features(batch, 'structure7')
-            # structure7 = structure7.transpose(0, 1)
-            # structure7 = structure7.transpose(1, 2)
-            #
-            # structure8 = make_features(batch, 'structure8')
-            # structure8 = structure8.transpose(0, 1)
-            # structure8 = structure8.transpose(1, 2)
+            structures = make_structure_features(batch, self.model.encoder.n_structures)
+            packing = self._maybe_pack(src, structures, src_lengths)
 
             # F-prop through the model.
-            outputs, attns = self.model(src, tgt, structure1, structure2, structure3, structure4, structure5,
-                                        src_lengths)
+            outputs, attns = self.model(src, tgt, structures, src_lengths, packing)
 
             # Compute loss.
             batch_stats = self.valid_loss.monolithic_compute_loss(
@@ -290,37 +267,11 @@ class Trainer(object):
 
             tgt_outer = make_features(batch, 'tgt')
 
-            structure1 = make_features(batch, 'structure1')
-            structure1 = structure1.transpose(0, 1)
-            structure1 = structure1.transpose(1, 2)
-
-            structure2 = make_features(batch, 'structure2')
-            structure2 = structure2.transpose(0, 1)
-            structure2 = structure2.transpose(1, 2)
-
-            structure3 = make_features(batch, 'structure3')
-            structure3 = structure3.transpose(0, 1)
-            structure3 = structure3.transpose(1, 2)
-
-            structure4 = make_features(batch, 'structure4')
-            structure4 = structure4.transpose(0, 1)
-            structure4 = structure4.transpose(1, 2)
-
-            structure5 = make_features(batch, 'structure5')
-            structure5 = structure5.transpose(0, 1)
-            structure5 = structure5.transpose(1, 2)
-
-            # structure6 = make_features(batch, 'structure6')
-            # structure6 = structure6.transpose(0, 1)
-            # structure6 = structure6.transpose(1, 2)
-            #
-            # structure7 = make_features(batch, 'structure7')
-            # structure7 = structure7.transpose(0, 1)
-            # structure7 = structure7.transpose(1, 2)
-            #
-            # structure8 = make_features(batch, 'structure8')
-            # structure8 = structure8.transpose(0, 1)
-            # structure8 = structure8.transpose(1, 2)
+            structures = make_structure_features(batch, self.model.encoder.n_structures)
+            packing = self._maybe_pack(src, structures, src_lengths)
+            structure_stats = self._structure_stats(src, src_lengths, packing)
+            total_stats.update(structure_stats)
+            report_stats.update(structure_stats)
 
             for j in range(0, target_size - 1, trunc_size):
                 # 1. Create truncated target.
@@ -329,8 +280,7 @@ class Trainer(object):
                 # 2. F-prop all but generator.
                 if self.grad_accum_count == 1:
                     self.model.zero_grad()
-                outputs, attns = self.model(src, tgt, structure1, structure2, structure3, structure4, structure5,
-                                            src_lengths)
+                outputs, attns = self.model(src, tgt, structures, src_lengths, packing)
 
                 # 3. Compute loss in shards for memory efficiency.
                 batch_stats = self.train_loss.sharded_compute_loss(
@@ -368,6 +318,31 @@ class Trainer(object):
                     grads, float(1))
             self.optim.step()
 
+    def _maybe_pack(self, src, structures, src_lengths):
+        """
+        Pack the graphs of a batch if `pack_graphs` is set, else None
+        """
+        if not self.pack_graphs:
+            return None
+        encoder = self.model.encoder
+        return pack_graphs(src, structures, src_lengths,
+                           encoder.embeddings.word_padding_idx,
+                           encoder.structure_embeddings.word_padding_idx)
+
+    def _structure_stats(self, src, src_lengths, packing=None):
+        """
+        Count the structure cells of a batch that are graph, and those that
+        are computed, packed or padded
+        """
+        stats = Statistics()
+        if packing is not None:
+            stats.n_structure_cells = packing.n_cells
+            stats.n_computed_cells = packing.n_packed_cells
+        else:
+            stats.n_structure_cells = int((src_lengths ** 2).sum())
+            stats.n_computed_cells = src.size(1) * src.size(0) ** 2
+        return stats
+
     def _start_report_manager(self, start_time=None):
         """
         Simple function to start report manager (if any)
@@ -415,9 +390,18 @@ class Trainer(object):
                 learning_rate, step, train_stats=train_stats,
                 valid_stats=valid_stats)
 
-    def _maybe_save(self, step):
+    def _maybe_save(self, step, train_iter=None):
         """
         Save the model if a model saver is set
         """
         if self.model_saver is not None:
-            self.model_saver.maybe_save(step)
+            train_iter_state = None
+            if train_iter is not None:
+                train_iter_state = train_iter.state_dict()
+                if self.n_gpu > 1:
+                    # The other ranks have consumed the batches up to the
+                    # next multiple of n_gpu, so resume after them.
+                    cursor = train_iter_state['iterator']['iterations_this_epoch']
+                    train_iter_state['iterator']['iterations_this_epoch'] = \
+                        -(-cursor // self.n_gpu) * self.n_gpu
+            self.model_saver.maybe_save(step, train_iter_state)
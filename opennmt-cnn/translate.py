@@ -6,6 +6,7 @@ from __future__ import unicode_literals
 import codecs
 
 import configargparse
+import torch
 
 import onmt.opts as opts
 from inputters.dataset import make_text_iterator_from_file
@@ -14,6 +15,10 @@ from utils.logging import init_logger
 
 
 def main(opt):
+    if opt.seed > 0:
+        torch.manual_seed(opt.seed)
+    if opt.threads > 1:
+        torch.set_num_threads(max(1, torch.get_num_threads() // opt.threads))
     translator = build_translator(opt)
     out_file = codecs.open(opt.output, 'w+', 'utf-8')
 
@@ -24,40 +29,20 @@ def main(opt):
     else:
         tgt_iter = None
 
-    if opt.structure1 is not None:
-        structure_iter1 = make_text_iterator_from_file(opt.structure1)
-    else:
-        structure_iter1 = None
-
-    if opt.structure2 is not None:
-        structure_iter2 = make_text_iterator_from_file(opt.structure2)
-    else:
-        structure_iter2 = None
-
-    if opt.structure3 is not None:
-        structure_iter3 = make_text_iterator_from_file(opt.structure3)
-    else:
-        structure_iter3 = None
-
-    if opt.structure4 is not None:
-        structure_iter4 = make_text_iterator_from_file(opt.structure4)
-    else:
-        structure_iter4 = None
-
-    if opt.structure5 is not None:
-        structure_iter5 = make_text_iterator_from_file(opt.structure5)
-    else:
-        structure_iter5 = None
+    structure_iters = []
+    for i in range(translator.n_structures):
+        structure_path = getattr(opt, 'structure%d' % (i + 1))
+        if structure_path is None:
+            raise AssertionError("The model uses %d structure channels, -structure%d is missing"
+                                 % (translator.n_structures, i + 1))
+        structure_iters.append(make_text_iterator_from_file(structure_path))
 
     translator.translate(src_data_iter=src_iter,
                          tgt_data_iter=tgt_iter,
-                         structure_iter1=structure_iter1,
-                         structure_iter2=structure_iter2,
-                         structure_iter3=structure_iter3,
-                         structure_iter4=structure_iter4,
-                         structure_iter5=structure_iter5,
+                         structure_iters=structure_iters,
                          batch_size=opt.batch_size,
-                         out_file=out_file)
+                         out_file=out_file,
+                         chunk_size=opt.chunk_size)
     out_file.close()
 
 
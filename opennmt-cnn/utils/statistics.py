@@ -19,6 +19,7 @@ class Statistics(object):
     * accuracy
     * perplexity
     * elapsed time
+    * structure padding efficiency
     """
 
     def __init__(self, loss=0, n_words=0, n_correct=0):
@@ -26,6 +27,8 @@ class Statistics(object):
         self.n_words = n_words
         self.n_correct = n_correct
         self.n_src_words = 0
+        self.n_structure_cells = 0
+        self.n_computed_cells = 0
         self.start_time = time.time()
 
     @staticmethod
@@ -82,6 +85,8 @@ class Statistics(object):
         self.loss += stat.loss
         self.n_words += stat.n_words
         self.n_correct += stat.n_correct
+        self.n_structure_cells += stat.n_structure_cells
+        self.n_computed_cells += stat.n_computed_cells
 
         if update_n_src_words:
             self.n_src_words += stat.n_src_words
@@ -98,6 +103,10 @@ class Statistics(object):
         """ compute perplexity """
         return math.exp(min(self.loss / self.n_words, 100))
 
+    def padding_efficiency(self):
+        """ compute the share of structure cells that are not padding """
+        return 100 * (self.n_structure_cells / self.n_computed_cells)
+
     def elapsed_time(self):
         """ compute elapsed time """
         return time.time() - self.start_time
@@ -122,6 +131,9 @@ class Statistics(object):
                self.n_src_words / (t + 1e-5),
                self.n_words / (t + 1e-5),
                time.time() - start))
+        if self.n_computed_cells > 0:
+            logger.info("Step %2d/%5d; structure padding efficiency: %6.2f"
+                        % (step, num_steps, self.padding_efficiency()))
         sys.stdout.flush()
 
     def log_tensorboard(self, prefix, writer, learning_rate, step):
@@ -132,3 +144,6 @@ class Statistics(object):
         writer.add_scalar(prefix + "/accuracy", self.accuracy(), step)
         writer.add_scalar(prefix + "/tgtper", self.n_words / t, step)
         writer.add_scalar(prefix + "/lr", learning_rate, step)
+        if self.n_computed_cells > 0:
+            writer.add_scalar(prefix + "/padding_efficiency",
+                              self.padding_efficiency(), step)
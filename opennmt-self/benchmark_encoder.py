@@ -0,0 +1,113 @@
+#!/usr/bin/env python
+"""
+Time and peak memory of the encoder on random graphs, for each of the
+-structure_encoder modes given with -compare, e.g.
+
+    python benchmark_encoder.py -n_nodes 60 -batch_size 8 -enc_layers 6 \
+        -heads 8 -enc_rnn_size 512 -src_word_vec_size 512 -backward
+
+On GPU the peak memory is the peak of allocated tensors, on CPU it is how
+much the maximum resident set size of the process grew during the passes.
+"""
+from __future__ import print_function
+
+import resource
+import time
+
+import configargparse
+import torch
+
+import onmt.opts as opts
+from onmt.embeddings import Embeddings
+from onmt.transformer_encoder import TransformerEncoder
+
+PAD_IDX = 1
+
+
+def build_encoder(opt, structure_encoder):
+    embeddings = Embeddings(opt.src_word_vec_size, opt.vocab_size, PAD_IDX,
+                            position_encoding=opt.position_encoding, dropout=opt.dropout)
+    structure_embeddings = Embeddings(64, opt.vocab_size, PAD_IDX,
+                                      position_encoding=opt.position_encoding, dropout=opt.dropout)
+    return TransformerEncoder(opt.enc_layers, opt.enc_rnn_size, opt.heads, opt.transformer_ff, opt.dropout,
+                              embeddings, structure_embeddings, opt.structure_channels, structure_encoder,
+                              opt.structure_paths, opt.structure_attention, opt.attention_max_memory)
+
+
+def random_batch(opt, device):
+    src = torch.randint(PAD_IDX + 1, opt.vocab_size, (opt.n_nodes, opt.batch_size), device=device)
+    if opt.n_paths > 0:
+        paths = torch.randint(PAD_IDX + 1, opt.vocab_size, (opt.n_paths, opt.structure_channels), device=device)
+        pairs = torch.randint(0, opt.n_paths, (opt.n_nodes, opt.n_nodes, opt.batch_size), device=device)
+        structures = [paths[:, i][pairs] for i in range(opt.structure_channels)]
+    else:
+        structures = [torch.randint(PAD_IDX + 1, opt.vocab_size, (opt.n_nodes, opt.n_nodes, opt.batch_size),
+                                    device=device)
+                      for _ in range(opt.structure_channels)]
+    return src, structures
+
+
+def run(opt, structure_encoder, queue):
+    """ Benchmark one mode, put (seconds per pass, peak bytes) on `queue` """
+    torch.manual_seed(opt.seed)
+    cuda = opt.gpu > -1
+    if cuda:
+        torch.cuda.set_device(opt.gpu)
+    device = torch.device('cuda' if cuda else 'cpu')
+
+    encoder = build_encoder(opt, structure_encoder).to(device)
+    encoder.train(opt.backward)
+    src, structures = random_batch(opt, device)
+
+    def step():
+        with torch.set_grad_enabled(opt.backward):
+            _, out, _ = encoder(src, structures)
+            if opt.backward:
+                out.sum().backward()
+        if cuda:
+            torch.cuda.synchronize()
+
+    if cuda:
+        torch.cuda.reset_peak_memory_stats()
+        base = torch.cuda.memory_allocated()
+    else:
+        base = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    step()  # warm up
+
+    start = time.time()
+    for _ in range(opt.steps):
+        step()
+    elapsed = (time.time() - start) / opt.steps
+
+    if cuda:
+        peak = torch.cuda.max_memory_allocated() - base
+    else:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024 - base
+    queue.put((elapsed, peak))
+
+
+def main(opt):
+    mp = torch.multiprocessing.get_context('spawn')
+    print("batch %d x %d nodes, %d layers, %d channels, %s paths, %s attention, %s"
+          % (opt.batch_size, opt.n_nodes, opt.enc_layers, opt.structure_channels, opt.structure_paths,
+             opt.structure_attention, 'forward + backward' if opt.backward else 'forward'))
+    for structure_encoder in opt.compare:
+        queue = mp.SimpleQueue()
+        proc = mp.Process(target=run, args=(opt, structure_encoder, queue))
+        proc.start()
+        proc.join()
+        if proc.exitcode != 0:
+            raise AssertionError("Benchmark of %s failed" % structure_encoder)
+        elapsed, peak = queue.get()
+        print("%-10s %9.1f ms/pass %9.1f MB peak" % (structure_encoder, elapsed * 1000, peak / 2 ** 20))
+
+
+if __name__ == "__main__":
+    parser = configargparse.ArgumentParser(
+        description='benchmark_encoder.py',
+        formatter_class=configargparse.ArgumentDefaultsHelpFormatter)
+    opts.model_opts(parser)
+    opts.benchmark_opts(parser)
+
+    opt = parser.parse_args()
+    main(opt)
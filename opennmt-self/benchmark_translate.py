@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+"""
+Translation throughput for each of the -threads settings given with
+-compare_threads, all sharing one model, and with -compare_quantize for
+the model quantized to int8 as well, e.g.
+
+    python benchmark_translate.py -model model.pt -src test.src \
+        -structure1 test.s1 ... -tgt test.tgt -compare_threads 1 2 4 8
+
+The torch intra-op threads are divided among the decoding threads, as in
+translate.py. The translations of every setting are checked against
+those of the first one, and scored against -tgt if given, with BPE
+removed from both.
+"""
+from __future__ import print_function
+
+import codecs
+import contextlib
+import math
+import os
+import time
+from collections import Counter
+
+import configargparse
+import torch
+
+import onmt.opts as opts
+from inputters.dataset import build_dataset, make_text_iterator_from_file
+from onmt.transformer import quantize_model
+from onmt.translator import build_translator
+
+
+def corpus_bleu(hypotheses, references, max_order=4):
+    """ Corpus BLEU in % of tokenized `hypotheses`, one reference each """
+    matches, totals = [0] * max_order, [0] * max_order
+    hyp_len, ref_len = 0, 0
+    for hyp, ref in zip(hypotheses, references):
+        hyp, ref = hyp.split(), ref.split()
+        hyp_len += len(hyp)
+        ref_len += len(ref)
+        for n in range(1, max_order + 1):
+            hyp_ngrams = Counter(tuple(hyp[i:i + n]) for i in range(len(hyp) - n + 1))
+            ref_ngrams = Counter(tuple(ref[i:i + n]) for i in range(len(ref) - n + 1))
+            matches[n - 1] += sum((hyp_ngrams & ref_ngrams).values())
+            totals[n - 1] += max(len(hyp) - n + 1, 0)
+    if min(matches) == 0:
+        return 0.
+    log_precision = sum(math.log(float(m) / t) for m, t in zip(matches, totals)) / max_order
+    brevity_penalty = min(0., 1. - float(ref_len) / hyp_len)
+    return 100. * math.exp(log_precision + brevity_penalty)
+
+
+def remove_bpe(line):
+    return line.replace('@@ ', '').replace('@@', '').strip()
+
+
+def main(opt):
+    translator = build_translator(opt)
+    structure_paths = [getattr(opt, 'structure%d' % (i + 1)) for i in range(translator.n_structures)]
+    if None in structure_paths:
+        raise AssertionError("The model uses %d structure channels" % translator.n_structures)
+    data = build_dataset(translator.fields, make_text_iterator_from_file(opt.src), None,
+                         [make_text_iterator_from_file(path) for path in structure_paths],
+                         use_filter_pred=False)
+    references = None
+    if opt.tgt is not None:
+        references = [remove_bpe(line) for line in make_text_iterator_from_file(opt.tgt)]
+    n_sentences = len(data.examples) * opt.repeat
+    n_cores = torch.get_num_threads()
+
+    models = [('int8' if opt.quantize else 'fp32', translator.model)]
+    if opt.compare_quantize and not opt.quantize:
+        models.append(('int8', quantize_model(translator.model)))
+
+    print("%d sentences, batch size %d, beam size %d, %d cores"
+          % (n_sentences, opt.batch_size, opt.beam_size, n_cores))
+    reference, base_rate = None, None
+    for name, model in models:
+        translator.model = model
+        for threads in opt.compare_threads:
+            torch.set_num_threads(max(1, n_cores // threads))
+            translator.threads = threads
+            translator.batch_count = 0
+
+            start = time.time()
+            with codecs.open(os.devnull, 'w', 'utf-8') as null, contextlib.redirect_stdout(null):
+                for _ in range(opt.repeat):
+                    translations = translator.translate_dataset(data, opt.batch_size)
+            rate = n_sentences / (time.time() - start)
+
+            if reference is None:
+                reference, base_rate = translations, rate
+            same = 'same' if translations == reference else 'different'
+            bleu = ''
+            if references is not None:
+                bleu = '  BLEU %5.2f' % corpus_bleu([remove_bpe(t) for t in translations], references)
+            print("%-4s %3d threads %9.1f sent/s %6.2fx%s  %s output"
+                  % (name, threads, rate, rate / base_rate, bleu, same))
+
+
+if __name__ == "__main__":
+    parser = configargparse.ArgumentParser(
+        description='benchmark_translate.py',
+        formatter_class=configargparse.ArgumentDefaultsHelpFormatter)
+    opts.translate_opts(parser)
+    opts.benchmark_translate_opts(parser)
+
+    opt = parser.parse_args()
+    main(opt)
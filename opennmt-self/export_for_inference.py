@@ -0,0 +1,43 @@
+#!/usr/bin/env python
+"""
+Export a model as an inference checkpoint: its weights, the words of its
+vocab and its model opts, without the optimizer of a training
+checkpoint, e.g.
+
+    python export_for_inference.py -model model.pt -output model.inf.pt
+    python translate.py -model model.inf.pt -src test.src ...
+
+The checkpoint is memory mapped and loaded without unpickling objects,
+see :obj:`onmt.inference_checkpoint.load_inference_checkpoint`.
+"""
+import os
+
+import configargparse
+
+import onmt.opts as opts
+import onmt.transformer as nmt_model
+from onmt.inference_checkpoint import export_for_inference
+from utils.logging import init_logger, logger
+
+
+def main(opt):
+    dummy_parser = configargparse.ArgumentParser(description='export_for_inference.py')
+    opts.model_opts(dummy_parser)
+    dummy_opt = dummy_parser.parse_known_args([])[0]
+
+    checkpoint, model_opt, fields = nmt_model.load_test_checkpoint(opt.models[0], dummy_opt.__dict__)
+    model = nmt_model.build_base_model(model_opt, fields, False, checkpoint)
+    export_for_inference(model, fields, model_opt, opt.output, opt.dtype)
+    logger.info("Saved the inference checkpoint to %s (%.1f MB, from %.1f MB)"
+                % (opt.output, os.path.getsize(opt.output) / 2. ** 20, os.path.getsize(opt.models[0]) / 2. ** 20))
+
+
+if __name__ == "__main__":
+    parser = configargparse.ArgumentParser(
+        description='export_for_inference.py',
+        formatter_class=configargparse.ArgumentDefaultsHelpFormatter)
+    opts.export_for_inference_opts(parser)
+
+    opt = parser.parse_args()
+    init_logger()
+    main(opt)
@@ -0,0 +1,61 @@
+""" Lean checkpoints for translation: the weights, the vocab and the model opts only """
+import argparse
+from collections import Counter
+
+import torch
+from torchtext.vocab import Vocab
+
+INFERENCE_FORMAT = 'inference'
+DTYPES = {'float32': torch.float32, 'float16': torch.float16, 'bfloat16': torch.bfloat16}
+
+
+def _cast(state, dtype, cache):
+    """ `state` with its tensors cast to `dtype`, tied ones staying tied through `cache` """
+    cast = {}
+    for name, tensor in state.items():
+        key = (tensor.untyped_storage().data_ptr(), tensor.storage_offset(),
+               tuple(tensor.size()), tuple(tensor.stride()))
+        if key not in cache:
+            cache[key] = tensor.to(dtype)
+        cast[name] = cache[key]
+    return cast
+
+
+def export_for_inference(model, fields, model_opt, path, dtype='float32'):
+    """
+    Save the weights of `model` stored as `dtype`, the words of its vocabs
+    and `model_opt` as plain values, so that the file loads without the
+    pickled objects of a training checkpoint, see
+    :obj:`load_inference_checkpoint`.
+    """
+    state, cache = model.state_dict(), {}
+    torch.save({
+        'format': INFERENCE_FORMAT,
+        'dtype': dtype,
+        'model': _cast({k: v for k, v in state.items() if not k.startswith('generator.')},
+                       DTYPES[dtype], cache),
+        'generator': _cast({k[len('generator.'):]: v for k, v in state.items() if k.startswith('generator.')},
+                           DTYPES[dtype], cache),
+        'vocab': [(name, field.vocab.itos) for name, field in fields.items()
+                  if field is not None and 'vocab' in field.__dict__],
+        'opt': vars(model_opt),
+    }, path)
+
+
+def load_inference_checkpoint(path):
+    """
+    Load an inference checkpoint on CPU in the layout of a training one.
+    The file is memory mapped and unpickled with `weights_only`, so it
+    runs no code, and float32 weights are used in place, others are cast
+    to float32.
+    """
+    checkpoint = torch.load(path, map_location='cpu', mmap=True, weights_only=True)
+    if checkpoint.get('format') != INFERENCE_FORMAT:
+        raise AssertionError("%s is not an inference checkpoint" % path)
+    if checkpoint['dtype'] != 'float32':
+        cache = {}
+        checkpoint['model'] = _cast(checkpoint['model'], torch.float32, cache)
+        checkpoint['generator'] = _cast(checkpoint['generator'], torch.float32, cache)
+    checkpoint['vocab'] = [(name, Vocab(Counter(), specials=itos)) for name, itos in checkpoint['vocab']]
+    checkpoint['opt'] = argparse.Namespace(**checkpoint['opt'])
+    return checkpoint
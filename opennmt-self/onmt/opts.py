@@ -55,6 +55,32 @@ def model_opts(parser):
               help="""Size of decoder rnn hidden states.
                        Must be equal to enc_rnn_size except for
                        speech-to-text.""")
+    group.add('--structure_channels', '-structure_channels', type=int, default=4,
+              help="""Number of structure channels the encoder consumes.
+                       Only these channels are loaded, numericalized and
+                       embedded during training and translation.""")
+    group.add('--structure_encoder', '-structure_encoder', default='per_layer',
+              choices=['per_layer', 'shared'],
+              help="""How the encoder layers get the structure representation.
+                       per_layer: every layer encodes the embedded paths
+                       itself. shared: they are encoded once per forward and
+                       every layer only applies its own structure key/value
+                       projections.""")
+    group.add('--structure_paths', '-structure_paths', default='all',
+              choices=['all', 'unique'],
+              help="""Which paths the structure encoder runs on. all: the
+                       path of every concept pair. unique: only the distinct
+                       label paths of the batch, pairs gather their result.
+                       Both give the same outputs in evaluation, in training
+                       unique pairs share their structure dropout mask.""")
+    group.add('--structure_attention', '-structure_attention', default='dense',
+              choices=['dense', 'index'],
+              help="""How self attention adds the structure. dense: from a
+                       [batch, n, n, 64] tensor of pair vectors. index: from
+                       the table of encoded paths and the path id of every
+                       pair, scores are gathered and values scatter-added,
+                       so no per-pair vectors are built. index requires
+                       -structure_paths unique.""")
 
     # Attention options
     group = parser.add_argument_group('Model- Attention')
@@ -66,6 +92,12 @@ def model_opts(parser):
               help='Number of heads for transformer self-attention')
     group.add('--transformer_ff', '-transformer_ff', type=int, default=2048,
               help='Size of hidden transformer feed-forward')
+    group.add('--attention_max_memory', '-attention_max_memory', type=float, default=0,
+              help="""Memory budget in MB for the scores, attention and
+                       structure activations of one attention call. Queries
+                       are attended in blocks of rows to stay within it,
+                       with the same results. 0 attends all queries at
+                       once.""")
 
 
 def preprocess_opts(parser):
@@ -77,43 +109,48 @@ def preprocess_opts(parser):
               help="Path to the training source data")
     group.add('--train_tgt', '-train_tgt', required=True,
               help="Path to the training target data")
-    group.add('--train_structure1', '-train_structure1', required=True,
-              help="Path to the training structure data")
-    group.add('--train_structure2', '-train_structure2', required=True,
-              help="Path to the training structure data")
-    group.add('--train_structure3', '-train_structure3', required=True,
-              help="Path to the training structure data")
-    group.add('--train_structure4', '-train_structure4', required=True,
-              help="Path to the training structure data")
-    group.add('--train_structure5', '-train_structure5', required=True,
-              help="Path to the training structure data")
-    group.add('--train_structure6', '-train_structure6', required=True,
-              help="Path to the training structure data")
-    group.add('--train_structure7', '-train_structure7', required=True,
-              help="Path to the training structure data")
-    group.add('--train_structure8', '-train_structure8', required=True,
-              help="Path to the training structure data")
+    group.add('--train_structure1', '-train_structure1',
+              help="Path to the training structure data, channel 1")
+    group.add('--train_structure2', '-train_structure2',
+              help="Path to the training structure data, channel 2")
+    group.add('--train_structure3', '-train_structure3',
+              help="Path to the training structure data, channel 3")
+    group.add('--train_structure4', '-train_structure4',
+              help="Path to the training structure data, channel 4")
+    group.add('--train_structure5', '-train_structure5',
+              help="Path to the training structure data, channel 5")
+    group.add('--train_structure6', '-train_structure6',
+              help="Path to the training structure data, channel 6")
+    group.add('--train_structure7', '-train_structure7',
+              help="Path to the training structure data, channel 7")
+    group.add('--train_structure8', '-train_structure8',
+              help="Path to the training structure data, channel 8")
 
     group.add('--valid_src', '-valid_src', required=True,
               help="Path to the validation source data")
     group.add('--valid_tgt', '-valid_tgt', required=True,
               help="Path to the validation target data")
-    group.add('--valid_structure1', '-valid_structure1', required=True,
-              help="Path to the validation structure data")
-    group.add('--valid_structure2', '-valid_structure2', required=True,
-              help="Path to the validation structure data")
-    group.add('--valid_structure3', '-valid_structure3', required=True,
-              help="Path to the validation structure data")
-    group.add('--valid_structure4', '-valid_structure4', required=True,
-              help="Path to the validation structure data")
-    group.add('--valid_structure5', '-valid_structure5', required=True,
-              help="Path to the validation structure data")
-    group.add('--valid_structure6', '-valid_structure6', required=True,
-              help="Path to the validation structure data")
-    group.add('--valid_structure7', '-valid_structure7', required=True,
-              help="Path to the validation structure data")
-    group.add('--valid_structure8', '-valid_structure8', required=True,
-              help="Path to the validation structure data")
+    group.add('--valid_structure1', '-valid_structure1',
+              help="Path to the validation structure data, channel 1")
+    group.add('--valid_structure2', '-valid_structure2',
+              help="Path to the validation structure data, channel 2")
+    group.add('--valid_structure3', '-valid_structure3',
+              help="Path to the validation structure data, channel 3")
+    group.add('--valid_structure4', '-valid_structure4',
+              help="Path to the validation structure data, channel 4")
+    group.add('--valid_structure5', '-valid_structure5',
+              help="Path to the validation structure data, channel 5")
+    group.add('--valid_structure6', '-valid_structure6',
+              help="Path to the validation structure data, channel 6")
+    group.add('--valid_structure7', '-valid_structure7',
+              help="Path to the validation structure data, channel 7")
+    group.add('--valid_structure8', '-valid_structure8',
+              help="Path to the validation structure data, channel 8")
+
+    group.add('--structure_channels', '-structure_channels', type=int, default=4,
+              help="""Number of structure channels to read, i.e. how many
+                       labels along each path are kept. Channels
+                       1..structure_channels must be given.""")
 
     group.add('--src_dir', '-src_dir', default="",
               help="Source directory for image or audio files.")
@@ -194,6 +231,16 @@ def train_opts(parser):
     group.add('--data', '-data', required=True,
               help="""Path prefix to the ".train.pt" and
                        ".valid.pt" file path from preprocess.py""")
+    group.add('--resident_data', '-resident_data', action='store_true',
+              help="""Load the train and valid shards once and keep them
+                       in memory for the whole run, a new epoch only
+                       reshuffles the examples. Use it when the data fits
+                       in RAM.""")
+    group.add('--resident_batches', '-resident_batches', action='store_true',
+              help="""With -resident_data, also keep the numericalized and
+                       padded batches in memory, a new epoch only
+                       reshuffles their order. The batch composition is
+                       then fixed for the whole run.""")
 
     group.add('--save_model', '-save_model', default='model',
               help="""Model filename (the model will be saved as
@@ -270,6 +317,11 @@ def train_opts(parser):
               choices=["sents", "tokens"],
               help="""Batch grouping for batch_size. Standard
                                is sents. Tokens will do dynamic batching""")
+    group.add('--pack_graphs', '-pack_graphs', action='store_true',
+              help="""Pack the small graphs of a batch side by side into
+                       shared rows with block diagonal structure and
+                       attention, so they do not pay for the n^2 structure
+                       of the largest graph.""")
     group.add('--normalization', '-normalization', default='sents',
               choices=["sents", "tokens"],
               help='Normalization method of the gradient.')
@@ -380,8 +432,8 @@ def train_opts(parser):
                        """)
 
 
-def translate_opts(parser):
-    """ Translation / inference options """
+def translate_opts(parser, data=True):
+    """ Translation / inference options, without the input and output files if not `data` """
     group = parser.add_argument_group('Model')
     group.add('--model', '-model', dest='models', metavar='MODEL',
               nargs='+', type=str, default=[], required=True,
@@ -389,29 +441,45 @@ def translate_opts(parser):
                    'Multiple models can be specified, '
                    'for ensemble decoding.')
 
-    group = parser.add_argument_group('Data')
+    if data:
+        group = parser.add_argument_group('Data')
 
-    group.add('--src', '-src', required=True, help="""Source sequence to decode (one line per
-                       sequence)""")
-    group.add('--tgt', '-tgt', help='True target sequence (optional)')
+        group.add('--src', '-src', required=True, help="""Source sequence to decode (one line per
+                           sequence)""")
+        group.add('--tgt', '-tgt', help='True target sequence (optional)')
 
-    group.add('--structure1', '-structure1', help='structure1')
-    group.add('--structure2', '-structure2', help='structure2')
-    group.add('--structure3', '-structure3', help='structure3')
-    group.add('--structure4', '-structure4', help='structure4')
-    group.add('--structure5', '-structure5', help='structure5')
-    group.add('--structure6', '-structure6', help='structure6')
-    group.add('--structure7', '-structure7', help='structure7')
-    group.add('--structure8', '-structure8', help='structure8')
+        group.add('--structure1', '-structure1', help='structure1')
+        group.add('--structure2', '-structure2', help='structure2')
+        group.add('--structure3', '-structure3', help='structure3')
+        group.add('--structure4', '-structure4', help='structure4')
+        group.add('--structure5', '-structure5', help='structure5')
+        group.add('--structure6', '-structure6', help='structure6')
+        group.add('--structure7', '-structure7', help='structure7')
+        group.add('--structure8', '-structure8', help='structure8')
 
-    group.add('--output', '-output', default='pred.txt',
-              help="""Path to output the predictions (each line will
-                       be the decoded sequence""")
+        group.add('--output', '-output', default='pred.txt',
+                  help="""Path to output the predictions (each line will
+                           be the decoded sequence""")
 
-    group.add('--share_vocab', '-share_vocab', action='store_true',
-              help="Share source and target vocabulary")
+        group.add('--share_vocab', '-share_vocab', action='store_true',
+                  help="Share source and target vocabulary")
 
     group = parser.add_argument_group('Beam')
+    group.add('--decode_strategy', '-decode_strategy', default='beam',
+              choices=['beam', 'greedy', 'topk'],
+              help="""Beam search, or a single hypothesis per sentence
+                       without beam bookkeeping: the most likely word
+                       (greedy) or a word sampled among the -sampling_topk
+                       most likely ones (topk) at every step.""")
+    group.add('--sampling_topk', '-sampling_topk', type=int, default=10,
+              help="Number of most likely words to sample from with topk")
+    group.add('--sampling_temp', '-sampling_temp', type=float, default=1.0,
+              help="""Temperature of the topk sampling, lower values are
+                       closer to greedy""")
+    group.add('--seed', '-seed', type=int, default=-1,
+              help="""Random seed of the topk sampling. The samples also
+                       depend on the batches, and are not reproducible with
+                       -threads > 1.""")
     group.add('--beam_size', '-beam_size', type=int, default=5,
               help='Beam size')
     group.add('--min_length', '-min_length', type=int, default=0,
@@ -450,5 +518,149 @@ def translate_opts(parser):
     group = parser.add_argument_group('Efficiency')
     group.add('--batch_size', '-batch_size', type=int, default=30,
               help='Batch size')
+    group.add('--batch_type', '-batch_type', default='sents', choices=['sents', 'tokens'],
+              help="""Batch grouping for batch_size. Tokens batches the
+                       sorted graphs up to a budget of structure cells,
+                       (n + 1)^2 per channel for n concepts, and of beam
+                       expanded target cells, beam rows of the decoding
+                       length, whichever is larger, times the graphs.""")
+    group.add('--chunk_size', '-chunk_size', type=int, default=0,
+              help="""Read and translate the input this many sentences at
+                       a time, sorting only within a chunk, and write each
+                       chunk as soon as it is done. 0 reads the whole
+                       input at once.""")
+    group.add('--pack_graphs', '-pack_graphs', action='store_true',
+              help="""Pack the small graphs of a batch side by side into
+                       shared rows with block diagonal structure and
+                       attention before encoding them.""")
+    group.add('--quantize', '-quantize', action='store_true',
+              help="""Quantize the Linear layers of the model to int8 at
+                       load time (dynamic quantization, CPU only).""")
+    group.add('--shortlist', '-shortlist',
+              help="""Decode every batch over a shortlist of the target
+                       vocabulary only, built from its source words with
+                       the table written by build_shortlist.py.""")
+    group.add('--scripted', '-scripted', action='store_true',
+              help="""-model is a TorchScript archive written by
+                       export_scripted.py, decoded without per step Python
+                       overhead in the model. -pack_graphs is not supported.""")
+    group.add('--threads', '-threads', type=int, default=1,
+              help="""Decode this many batches at once in separate threads
+                       sharing one model. The intra-op threads of torch are
+                       divided among them.""")
+    group.add('--workers', '-workers', type=int, default=1,
+              help="""translate.py: decode the input in this many forked
+                       processes sharing the model copy-on-write, each on a
+                       share of the sentences of about the same total source
+                       length. The intra-op threads of torch are divided
+                       among them (CPU only).""")
+    group.add('--cache_size', '-cache_size', type=int, default=0,
+              help="""Keep the translations of this many distinct inputs,
+                       by concepts, structure paths and decoding options,
+                       and do not translate them again. Repeated inputs are
+                       translated once. Not used with topk sampling.""")
+    group.add('--cache_encoder_size', '-cache_encoder_size', type=int, default=0,
+              help="""Keep the encoder outputs of this many distinct
+                       inputs, reused whatever the decoding options.""")
+    group.add('--cache_file', '-cache_file',
+              help="""Load the caches from this file if it exists and save
+                       them to it at the end, for the same model only.""")
     group.add('--gpu', '-gpu', type=int, default=-1,
               help="Device to run on")
+
+
+def benchmark_opts(parser):
+    """ Benchmarking options """
+    group = parser.add_argument_group('Benchmark')
+    group.add('--compare', '-compare', nargs='+', default=['per_layer', 'shared'],
+              choices=['per_layer', 'shared'],
+              help="""The -structure_encoder modes to run, each in a fresh
+                       process.""")
+    group.add('--batch_size', '-batch_size', type=int, default=16,
+              help="Number of graphs in a batch")
+    group.add('--n_nodes', '-n_nodes', type=int, default=40,
+              help="Number of concepts of every graph")
+    group.add('--vocab_size', '-vocab_size', type=int, default=1000,
+              help="Size of the random concept and structure vocabularies")
+    group.add('--n_paths', '-n_paths', type=int, default=0,
+              help="""Draw the label path of every concept pair from this
+                       many distinct random paths, as in real graphs where
+                       few label sequences repeat. 0 draws every label
+                       independently.""")
+    group.add('--steps', '-steps', type=int, default=10,
+              help="Number of timed passes, after one warm up pass")
+    group.add('--backward', '-backward', action='store_true',
+              help="Time forward and backward passes in training mode.")
+    group.add('--dropout', '-dropout', type=float, default=0.1,
+              help="Dropout probability")
+    group.add('--gpu', '-gpu', type=int, default=-1,
+              help="Device to run on")
+    group.add('--seed', '-seed', type=int, default=3435,
+              help="Random seed")
+
+
+def export_scripted_opts(parser):
+    """ Options of the TorchScript export """
+    group = parser.add_argument_group('Export')
+    group.add('--model', '-model', dest='models', metavar='MODEL', nargs=1, required=True,
+              help="Path to the model .pt file")
+    group.add('--output', '-output', required=True,
+              help="Path of the TorchScript archive, see translate.py -scripted")
+    group.add('--quantize', '-quantize', action='store_true',
+              help="Quantize the Linear layers to int8 before scripting, see translate.py -quantize")
+
+
+def export_for_inference_opts(parser):
+    """ Options of the inference checkpoint export """
+    group = parser.add_argument_group('Export')
+    group.add('--model', '-model', dest='models', metavar='MODEL', nargs=1, required=True,
+              help="Path to the model .pt file")
+    group.add('--output', '-output', required=True,
+              help="""Path of the inference checkpoint, translate.py and
+                       the other tools load it as any model""")
+    group.add('--dtype', '-dtype', default='float32', choices=['float32', 'float16', 'bfloat16'],
+              help="""Type the weights are stored as, half types halve the
+                       file and are cast back to float32 when loaded""")
+
+
+def shortlist_opts(parser):
+    """ Options of the shortlist table """
+    group = parser.add_argument_group('Shortlist')
+    group.add('--data', '-data', required=True,
+              help="""Path prefix to the preprocessed data, the table is
+                       counted on its train shards""")
+    group.add('--output', '-output', required=True,
+              help="Path of the shortlist table, see translate.py -shortlist")
+    group.add('--shortlist_lexical', '-shortlist_lexical', type=int, default=50,
+              help="""Number of target words kept for every source word,
+                       those co-occurring with it the most by Dice
+                       coefficient""")
+    group.add('--shortlist_frequent', '-shortlist_frequent', type=int, default=1000,
+              help="Number of most frequent target words always kept")
+
+
+def server_opts(parser):
+    """ Options of the translation server """
+    group = parser.add_argument_group('Server')
+    group.add('--port', '-port', type=int, default=0,
+              help="""Serve HTTP on this port of localhost. 0 reads JSON
+                       lines requests on stdin and answers on stdout.""")
+    group.add('--max_latency', '-max_latency', type=float, default=10,
+              help="""Milliseconds a request waits for others to be
+                       translated with it""")
+    group.add('--max_group', '-max_group', type=int, default=0,
+              help="""Maximal number of queued requests translated at
+                       once, sorted by size into batches of -batch_size.
+                       0 for -batch_size.""")
+
+
+def benchmark_translate_opts(parser):
+    """ Options of the translation throughput benchmark """
+    group = parser.add_argument_group('Benchmark')
+    group.add('--compare_threads', '-compare_threads', type=int, nargs='+', default=[1, 2, 4],
+              help="The -threads settings to time")
+    group.add('--repeat', '-repeat', type=int, default=1,
+              help="Translate the input this many times for each setting")
+    group.add('--compare_quantize', '-compare_quantize', action='store_true',
+              help="""Also time the model quantized to int8, see
+                       -quantize""")
@@ -2,6 +2,8 @@
 This file is for models creation, which consults options
 and creates each encoder and decoder accordingly.
 """
+import contextlib
+import pickle
 import re
 
 import torch
@@ -11,11 +13,15 @@ from torch.nn.init import xavier_uniform_
 import onmt.constants as Constants
 from inputters.dataset import load_fields_from_vocab
 from onmt.embeddings import Embeddings
+from onmt.inference_checkpoint import INFERENCE_FORMAT, load_inference_checkpoint
 from onmt.transformer_decoder import TransformerDecoder
 from onmt.transformer_encoder import TransformerEncoder
 from utils.logging import logger
 from utils.misc import use_gpu
 
+# Buffers that older checkpoints contain but that are now built on demand.
+OBSOLETE_BUFFERS = re.compile(r'(decoder\.transformer_layers\.\d+\.mask|.*\.make_embedding\.pe\.pe)$')
+
 
 class NMTModel(nn.Module):
     def __init__(self, encoder, decoder):
@@ -23,10 +29,9 @@ class NMTModel(nn.Module):
         self.encoder = encoder
         self.decoder = decoder
 
-    def forward(self, src, tgt, structure1, structure2, structure3, structure4, structure5, lengths):
+    def forward(self, src, tgt, structures, lengths, packing=None):
         tgt = tgt[:-1]  # exclude last target from inputs
-        _, memory_bank, lengths = self.encoder(src, structure1, structure2, structure3, structure4, structure5,
-                                               lengths)  # src: ......<EOS>
+        _, memory_bank, lengths = self.encoder(src, structures, lengths, packing)  # src: ......<EOS>
         self.decoder.init_state(src, memory_bank)
         dec_out, attns = self.decoder(tgt)
 
@@ -46,8 +51,7 @@ def build_embeddings(opt, word_dict, for_encoder='src'):
         embedding_dim = opt.src_word_vec_size  # 512
     elif for_encoder == 'tgt':
         embedding_dim = opt.tgt_word_vec_size
-    elif for_encoder == 'structure1' or for_encoder == 'structure2' or for_encoder == 'structure3' or for_encoder == 'structure4' \
-            or for_encoder == 'structure5' or for_encoder == 'structure6' or for_encoder == 'structure7' or for_encoder == 'structure8':
+    elif for_encoder.startswith('structure'):
         embedding_dim = 64
 
     word_padding_idx = word_dict.stoi[Constants.PAD_WORD]
@@ -76,7 +80,12 @@ def build_encoder(opt,
                               opt.transformer_ff,
                               opt.dropout,
                               embeddings,
-                              structure_embeddings)
+                              structure_embeddings,
+                              opt.structure_channels,
+                              opt.structure_encoder,
+                              opt.structure_paths,
+                              opt.structure_attention,
+                              opt.attention_max_memory)
 
 
 def build_decoder(opt, embeddings):
@@ -86,28 +95,55 @@ def build_decoder(opt, embeddings):
         opt: the option in current environment.
         embeddings (Embeddings): vocab embeddings for this decoder.
     """
-    return TransformerDecoder(opt.dec_layers, opt.dec_rnn_size, opt.heads, opt.transformer_ff, opt.dropout, embeddings)
-
+    return TransformerDecoder(opt.dec_layers, opt.dec_rnn_size, opt.heads, opt.transformer_ff, opt.dropout, embeddings,
+                              opt.attention_max_memory)
 
-def load_test_model(opt, dummy_opt, model_path=None):
-    if model_path is None:
-        model_path = opt.models[0]
-    checkpoint = torch.load(model_path, map_location=lambda storage, loc: storage)
 
-    fields = load_fields_from_vocab(checkpoint['vocab'])
+def load_test_checkpoint(model_path, dummy_opt):
+    """
+    Load the training or inference checkpoint `model_path`, its model opts
+    completed with the defaults of `dummy_opt`, and its fields.
+    """
+    try:
+        checkpoint = load_inference_checkpoint(model_path)
+    except pickle.UnpicklingError:
+        # A training checkpoint, with pickled objects.
+        checkpoint = torch.load(model_path, map_location=lambda storage, loc: storage)
 
     model_opt = checkpoint['opt']
 
     for arg in dummy_opt:
         if arg not in model_opt:
             model_opt.__dict__[arg] = dummy_opt[arg]
+
+    fields = load_fields_from_vocab(checkpoint['vocab'], model_opt.structure_channels)
+    return checkpoint, model_opt, fields
+
+
+def load_test_model(opt, dummy_opt, model_path=None):
+    if model_path is None:
+        model_path = opt.models[0]
+    checkpoint, model_opt, fields = load_test_checkpoint(model_path, dummy_opt)
     model = build_base_model(model_opt, fields, use_gpu(opt), checkpoint)
 
     model.eval()
     model.generator.eval()
+    if opt.quantize:
+        if use_gpu(opt):
+            raise AssertionError("-quantize is only supported on CPU")
+        model = quantize_model(model)
     return fields, model
 
 
+def quantize_model(model):
+    """
+    Copy of `model` with the weights of all its Linear layers, including the
+    structure projections and the generator, quantized to int8 and their
+    inputs quantized on the fly, for faster inference on CPU.
+    """
+    return torch.quantization.quantize_dynamic(model, {nn.Linear}, dtype=torch.qint8)
+
+
 def build_base_model(model_opt, fields, gpu, checkpoint=None):
     """
     Args:
@@ -125,6 +161,13 @@ def build_base_model(model_opt, fields, gpu, checkpoint=None):
         raise AssertionError("""We do not support different encoder and
                          decoder rnn sizes for translation now.""")
 
+    # An inference checkpoint has every weight: its tensors are taken as
+    # they are, so build the layers of the encoder, the decoder and the
+    # generator without allocating them. (The initialization of embeddings
+    # on the meta device is slow and they are small.)
+    inference = checkpoint is not None and checkpoint.get('format') == INFERENCE_FORMAT
+    skip_init = torch.device('meta') if inference else contextlib.nullcontext()
+
     # Bulid_structure
     structure_dict1 = fields["structure1"].vocab
     structure_embeddings1 = build_embeddings(model_opt, structure_dict1, for_encoder='structure1')
@@ -133,9 +176,10 @@ def build_base_model(model_opt, fields, gpu, checkpoint=None):
     src_embeddings = build_embeddings(model_opt, src_dict, for_encoder='src')
 
     # Build encoder.
-    encoder = build_encoder(model_opt,
-                            src_embeddings,
-                            structure_embeddings1)
+    with skip_init:
+        encoder = build_encoder(model_opt,
+                                src_embeddings,
+                                structure_embeddings1)
 
     # Build decoder.
     tgt_dict = fields["tgt"].vocab
@@ -150,7 +194,8 @@ def build_base_model(model_opt, fields, gpu, checkpoint=None):
 
         tgt_embeddings.word_lut.weight = src_embeddings.word_lut.weight
     # Build decoder.
-    decoder = build_decoder(model_opt, tgt_embeddings)
+    with skip_init:
+        decoder = build_decoder(model_opt, tgt_embeddings)
 
     # Build NMTModel(= encoder + decoder).
     device = torch.device("cuda" if gpu else "cpu")
@@ -158,15 +203,24 @@ def build_base_model(model_opt, fields, gpu, checkpoint=None):
 
     # Build Generator.
     gen_func = nn.LogSoftmax(dim=-1)
-    generator = nn.Sequential(
-        nn.Linear(model_opt.dec_rnn_size, len(fields["tgt"].vocab)),
-        gen_func
-    )
+    with skip_init:
+        generator = nn.Sequential(
+            nn.Linear(model_opt.dec_rnn_size, len(fields["tgt"].vocab)),
+            gen_func
+        )
     if model_opt.share_decoder_embeddings:
         generator[0].weight = decoder.embeddings.word_lut.weight
 
     # Load the model states from checkpoint or initialize them.
-    if checkpoint is not None:
+    if inference:
+        model.load_state_dict(checkpoint['model'], assign=True)
+        generator.load_state_dict(checkpoint['generator'], assign=True)
+        # Assigning replaced the tied parameters one by one.
+        if model_opt.share_embeddings:
+            tgt_embeddings.word_lut.weight = src_embeddings.word_lut.weight
+        if model_opt.share_decoder_embeddings:
+            generator[0].weight = decoder.embeddings.word_lut.weight
+    elif checkpoint is not None:
         # This preserves backward-compat for models using customed layernorm
         def fix_key(s):
             s = re.sub(r'(.*)\.layer_norm((_\d+)?)\.b_2',
@@ -176,7 +230,8 @@ def build_base_model(model_opt, fields, gpu, checkpoint=None):
             return s
 
         checkpoint['model'] = \
-            {fix_key(k): v for (k, v) in checkpoint['model'].items()}
+            {fix_key(k): v for (k, v) in checkpoint['model'].items()
+             if not OBSOLETE_BUFFERS.match(k)}
         # end of patch for backward compatibility
 
         model.load_state_dict(checkpoint['model'], strict=False)
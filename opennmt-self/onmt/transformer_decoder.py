@@ -2,25 +2,44 @@
 Implementation of "Attention is All You Need"
 """
 
-import numpy as np
+import threading
+
 import torch
 import torch.nn as nn
 
 import onmt
 from onmt.sublayer import PositionwiseFeedForward
 
-MAX_SIZE = 5000
+# Causal masks shared by all decoder layers, one per device.
+_subsequent_masks = {}
+_subsequent_masks_lock = threading.Lock()
+
+
+def get_subsequent_mask(size, device):
+    """
+    Mask `[1 x size x size]` of the future positions (1 above the
+    diagonal). The mask is built on first use and grown on demand, it is
+    not part of any state_dict.
+    """
+    with _subsequent_masks_lock:
+        mask = _subsequent_masks.get(device)
+        if mask is None or mask.size(-1) < size:
+            if mask is not None:
+                size = max(size, 2 * mask.size(-1))
+            mask = torch.triu(torch.ones(1, size, size, dtype=torch.uint8, device=device), diagonal=1)
+            _subsequent_masks[device] = mask
+    return mask
 
 
 class TransformerDecoderLayer(nn.Module):
-    def __init__(self, d_model, heads, d_ff, dropout):
+    def __init__(self, d_model, heads, d_ff, dropout, max_memory=0):
         super(TransformerDecoderLayer, self).__init__()
 
         self.self_attn = onmt.sublayer.MultiHeadedAttention(
-            heads, d_model, dropout=dropout)
+            heads, d_model, dropout=dropout, max_memory=max_memory)
 
         self.context_attn = onmt.sublayer.MultiHeadedAttention(
-            heads, d_model, dropout=dropout)
+            heads, d_model, dropout=dropout, max_memory=max_memory)
 
         self.feed_forward = PositionwiseFeedForward(d_model, d_ff, dropout)
 
@@ -29,25 +48,22 @@ class TransformerDecoderLayer(nn.Module):
 
         self.dropout = dropout
         self.drop = nn.Dropout(dropout)
-        mask = self._get_attn_subsequent_mask(MAX_SIZE)
-        # Register self.mask as a buffer in TransformerDecoderLayer, so
-        # it gets TransformerDecoderLayer's cuda behavior automatically.
-        self.register_buffer('mask', mask)
 
     def forward(self, inputs, memory_bank, src_pad_mask, tgt_pad_mask,
                 layer_cache=None, step=None):
         dec_mask = None
         if step is None:
-            dec_mask = torch.gt(tgt_pad_mask +
-                                self.mask[:, :tgt_pad_mask.size(-1),
-                                :tgt_pad_mask.size(-1)], 0)
+            tgt_len = tgt_pad_mask.size(-1)
+            mask = get_subsequent_mask(tgt_len, tgt_pad_mask.device)
+            dec_mask = torch.gt(tgt_pad_mask + mask[:, :tgt_len, :tgt_len], 0)
 
         input_norm = self.layer_norm_1(inputs)
 
         query, attn = self.self_attn(input_norm, input_norm, input_norm,
                                      mask=dec_mask,
                                      layer_cache=layer_cache,
-                                     type="self")
+                                     type="self",
+                                     step=step)
 
         query = self.drop(query) + inputs
 
@@ -60,15 +76,9 @@ class TransformerDecoderLayer(nn.Module):
 
         return output, attn
 
-    def _get_attn_subsequent_mask(self, size):
-        attn_shape = (1, size, size)
-        subsequent_mask = np.triu(np.ones(attn_shape), k=1).astype('uint8')
-        subsequent_mask = torch.from_numpy(subsequent_mask)
-        return subsequent_mask
-
 
 class TransformerDecoder(nn.Module):
-    def __init__(self, num_layers, d_model, heads, d_ff, dropout, embeddings):
+    def __init__(self, num_layers, d_model, heads, d_ff, dropout, embeddings, max_memory=0):
         super(TransformerDecoder, self).__init__()
 
         # Basic attributes.
@@ -76,35 +86,78 @@ class TransformerDecoder(nn.Module):
         self.num_layers = num_layers
         self.embeddings = embeddings
 
-        # Decoder State
-        self.state = {}
+        # Decoder State, kept per thread so that several threads can decode
+        # with the same decoder at once.
+        self._local = threading.local()
 
         # Build TransformerDecoder.
         self.transformer_layers = nn.ModuleList(
-            [TransformerDecoderLayer(d_model, heads, d_ff, dropout)
+            [TransformerDecoderLayer(d_model, heads, d_ff, dropout, max_memory)
              for _ in range(num_layers)])
 
         self.layer_norm = nn.LayerNorm(d_model, eps=1e-6)
 
-    def init_state(self, src, src_enc):
-        """ Init decoder state """
+    def __getstate__(self):
+        # The per thread state is not copied or pickled with the decoder.
+        state = self.__dict__.copy()
+        del state['_local']
+        return state
+
+    def __setstate__(self, state):
+        super(TransformerDecoder, self).__setstate__(state)
+        self._local = threading.local()
+
+    @property
+    def state(self):
+        """ Decoder state of the calling thread """
+        if not hasattr(self._local, 'state'):
+            self._local.state = {}
+        return self._local.state
+
+    def init_state(self, src, src_enc, max_length=None):
+        """
+        Init decoder state. `max_length` is the number of steps to
+        preallocate the self attention cache for, it grows past it if needed.
+        The `tgt` of the following steps may hold several hypotheses per
+        sentence of `src`, next to each other, which share its memory.
+        """
         self.state["src"] = src
         self.state["src_enc"] = src_enc
         self.state["cache"] = None
+        self.state["max_length"] = max_length
+        self.state["cache_length"] = 0
 
-    def map_state(self, fn):
-        def _recursive_map(struct, batch_dim=0):
-            for k, v in struct.items():
-                if v is not None:
-                    if isinstance(v, dict):
-                        _recursive_map(v)
-                    else:
-                        struct[k] = fn(v, batch_dim)
-
-        self.state["src"] = fn(self.state["src"], 1)
-        self.state["src_enc"] = fn(self.state["src_enc"], 1)
+    def map_state(self, fn, memory_fn=None):
+        """
+        Apply `fn(state, batch_dim)` to the self attention cache, which has
+        an entry per hypothesis, and `memory_fn` to the source side (src,
+        memory bank and memory keys/values), which has an entry per sentence
+        shared by all its hypotheses. The source side is kept as is if
+        `memory_fn` is None, otherwise it is also cut to the longest source
+        left, so that dropping sentences also shortens the memory.
+        """
+        src_len = None
+        if memory_fn is not None:
+            src = memory_fn(self.state["src"], 1)
+            src_len = int(src.ne(self.embeddings.word_padding_idx).sum(0).max())
+            self.state["src"] = src[:src_len]
+            self.state["src_enc"] = memory_fn(self.state["src_enc"][:src_len], 1)
         if self.state["cache"] is not None:
-            _recursive_map(self.state["cache"])
+            length = self.state["cache_length"]
+            for layer_cache in self.state["cache"].values():
+                for k, v in layer_cache.items():
+                    if v is None:
+                        continue
+                    if k.startswith("memory_"):
+                        if memory_fn is not None:
+                            layer_cache[k] = memory_fn(v[:, :, :src_len], 0)
+                    else:
+                        # Only map the filled steps of the preallocated cache.
+                        filled = fn(v[:, :, :length], 0)
+                        if filled.size(0) != v.size(0):
+                            v = v.new_empty(filled.size(0), *v.size()[1:])
+                        v[:, :, :length] = filled
+                        layer_cache[k] = v
 
     def detach_state(self):
         self.state["src"] = self.state["src"].detach()
@@ -114,7 +167,7 @@ class TransformerDecoder(nn.Module):
     See :obj:`onmt.modules.RNNDecoderBase.forward()`
     """
         if step == 0:
-            self._init_cache(self.num_layers)
+            self._init_cache(self.num_layers, tgt.size(1))
 
         src = self.state["src"]
         memory_bank = self.state["src_enc"]
@@ -148,6 +201,8 @@ class TransformerDecoder(nn.Module):
                 step=step)
 
         output = self.layer_norm(output)
+        if step is not None:
+            self.state["cache_length"] = step + tgt.size(0)
 
         # Process the result and update the attentions.
         dec_outs = output.transpose(0, 1).contiguous()
@@ -158,8 +213,11 @@ class TransformerDecoder(nn.Module):
         # TODO change the way attns is returned dict => list or tuple (onnx)
         return dec_outs, attns
 
-    def _init_cache(self, num_layers):
+    def _init_cache(self, num_layers, batch_size):
         self.state["cache"] = {}
+        self.state["cache_length"] = 0
+        max_length = self.state["max_length"]
+        src_enc = self.state["src_enc"]
 
         for l in range(num_layers):
             layer_cache = {
@@ -168,4 +226,9 @@ class TransformerDecoder(nn.Module):
             }
             layer_cache["self_keys"] = None
             layer_cache["self_values"] = None
+            if max_length is not None:
+                self_attn = self.transformer_layers[l].self_attn
+                size = (batch_size, self_attn.head_count, max_length, self_attn.dim_per_head)
+                layer_cache["self_keys"] = src_enc.new_empty(size)
+                layer_cache["self_values"] = src_enc.new_empty(size)
             self.state["cache"]["layer_{}".format(l)] = layer_cache
@@ -0,0 +1,157 @@
+""" Translation of queued requests in dynamically formed batches """
+from __future__ import print_function
+
+import codecs
+import contextlib
+import math
+import os
+import queue
+import threading
+import time
+from collections import deque
+
+from inputters.dataset import build_dataset
+from utils.logging import logger
+
+
+class TranslationRequest(object):
+    """ One sentence to translate, `callback(request)` is called once it is done """
+
+    def __init__(self, src, structures, callback):
+        self.src = src
+        self.structures = structures
+        self.callback = callback
+        self.arrival = time.time()
+        self.translation = None
+        self.error = None
+
+
+class TranslationServer(object):
+    """
+    Translate requests from any number of threads with one translator. A
+    request waits at most `max_latency` seconds for others to arrive, then
+    the queued requests, up to `max_group` sentences, are sorted by size
+    and translated in batches of `batch_size`.
+
+    Args:
+        translator (:obj:`onmt.translator.Translator`): translator
+        batch_size (int): sentences of every batch
+        max_latency (float): seconds the first queued request waits
+        max_group (int): sentences translated at once, 0 for `batch_size`
+        history (int): number of last requests the latency percentiles and
+            the last batches the fill statistics are computed on
+    """
+
+    def __init__(self, translator, batch_size, max_latency, max_group=0, history=10000):
+        self.translator = translator
+        self.batch_size = batch_size
+        self.max_latency = max_latency
+        self.max_group = max_group if max_group > 0 else batch_size
+        self._queue = queue.Queue()
+        self._stats_lock = threading.Lock()
+        self._latencies = deque(maxlen=history)
+        # (sentences, batches) of every translated group
+        self._groups = deque(maxlen=history)
+        self.n_requests = 0
+        self.n_errors = 0
+        self.translator.batch_count = 0
+
+        self._worker = threading.Thread(target=self._run, name='translation-server')
+        self._worker.daemon = True
+        self._worker.start()
+
+    def submit(self, src, structures, callback):
+        """
+        Queue the concept sequence `src` with its structure paths, one line
+        per channel, and return at once. `callback` is called from the
+        server thread with the :obj:`TranslationRequest` when it is done.
+        """
+        if len(structures) != self.translator.n_structures:
+            raise ValueError("The model uses %d structure channels, got %d"
+                             % (self.translator.n_structures, len(structures)))
+        request = TranslationRequest(src, structures, callback)
+        self._queue.put(request)
+        return request
+
+    def translate(self, src, structures):
+        """ Translate one sentence, blocking until it is done """
+        done = threading.Event()
+        request = self.submit(src, structures, lambda _: done.set())
+        done.wait()
+        if request.error is not None:
+            raise RuntimeError(request.error)
+        return request.translation
+
+    def _run(self):
+        while True:
+            group = [self._queue.get()]
+            deadline = group[0].arrival + self.max_latency
+            while len(group) < self.max_group:
+                timeout = deadline - time.time()
+                if timeout <= 0:
+                    break
+                try:
+                    group.append(self._queue.get(timeout=timeout))
+                except queue.Empty:
+                    break
+            self._translate_group(group)
+
+    def _translate_group(self, group):
+        """ Translate the `group` of requests and call back each of them """
+        n_batches, failed = 0, False
+        try:
+            data = build_dataset(self.translator.fields, [r.src for r in group], None,
+                                 [[r.structures[i] for r in group] for i in range(self.translator.n_structures)],
+                                 use_filter_pred=False)
+            batch_count = self.translator.batch_count
+            # The translator prints every sentence, which a server does not need.
+            with codecs.open(os.devnull, 'w', 'utf-8') as null, contextlib.redirect_stdout(null):
+                translations = self.translator.translate_dataset(data, self.batch_size)
+            n_batches = self.translator.batch_count - batch_count
+            for request, translation in zip(group, translations):
+                request.translation = translation
+        except Exception as e:
+            logger.exception("Translation of %d requests failed" % len(group))
+            for request in group:
+                # Some exceptions have no message, their repr names the type at least.
+                request.error = str(e) or repr(e)
+            failed = True
+
+        done = time.time()
+        with self._stats_lock:
+            self.n_requests += len(group)
+            if failed:
+                self.n_errors += len(group)
+            elif n_batches > 0:
+                # A group answered from the cache alone has no batch.
+                self._groups.append((len(group), n_batches))
+            self._latencies.extend(done - r.arrival for r in group)
+        for request in group:
+            request.callback(request)
+
+    def stats(self):
+        """
+        Request latency percentiles in milliseconds, over the last requests,
+        the mean fill of the last batches, translated sentences over
+        `batch_size` (with -batch_type sents), and the cache hit rates.
+        """
+        with self._stats_lock:
+            latencies = sorted(self._latencies)
+            groups = list(self._groups)
+            stats = {'requests': self.n_requests, 'errors': self.n_errors, 'queued': self._queue.qsize()}
+
+        def percentile(p):
+            return 1000. * latencies[min(len(latencies) - 1, int(math.ceil(p / 100. * len(latencies))) - 1)]
+
+        if latencies:
+            stats.update(('latency_p%d_ms' % p, round(percentile(p), 1)) for p in (50, 90, 99))
+        sentences = sum(n for n, _ in groups)
+        batches = sum(b for _, b in groups)
+        if batches:
+            stats['batches'] = batches
+            stats['sentences_per_batch'] = round(float(sentences) / batches, 2)
+            if self.translator.batch_type == 'sents':
+                stats['batch_fill'] = round(float(sentences) / (batches * self.batch_size), 3)
+        if self.translator.cache is not None:
+            stats['cache'] = self.translator.cache.stats()
+        return stats
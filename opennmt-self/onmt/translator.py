@@ -2,7 +2,16 @@
 """ Translator Class and builder """
 from __future__ import print_function
 
+import contextlib
+import heapq
+import io
+import multiprocessing
+import os
+import threading
 import time
+import traceback
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 
 import configargparse
 import torch
@@ -10,9 +19,12 @@ import torch
 import onmt.constants as Constants
 import onmt.opts as opts
 import onmt.transformer as nmt_model
-from inputters.dataset import build_dataset, OrderedIterator, make_features
-from onmt.beam import Beam
-from utils.misc import tile
+from inputters.dataset import build_dataset, OrderedIterator, make_features, make_structure_features, \
+    make_chunked_iterators, pack_graphs
+from onmt.beam import BeamSearch
+from onmt.scripted import load_scripted_model
+from onmt.shortlist import Shortlist
+from onmt.translation_cache import TranslationCache
 
 
 def build_translator(opt):
@@ -20,13 +32,30 @@ def build_translator(opt):
     opts.model_opts(dummy_parser)
     dummy_opt = dummy_parser.parse_known_args([])[0]
 
-    fields, model = nmt_model.load_test_model(opt, dummy_opt.__dict__)
+    if opt.scripted:
+        fields, model = load_scripted_model(opt.models[0], torch.device('cuda' if opt.gpu > -1 else 'cpu'))
+    else:
+        fields, model = nmt_model.load_test_model(opt, dummy_opt.__dict__)
 
     translator = Translator(model, fields, opt)
 
     return translator
 
 
+def balance_shares(lengths, n):
+    """
+    Split the indexes of `lengths` into at most `n` shares of about the
+    same total length, each in increasing order.
+    """
+    shares = [[] for _ in range(n)]
+    loads = [(0, i) for i in range(n)]
+    for index in sorted(range(len(lengths)), key=lambda i: -lengths[i]):
+        load, share = heapq.heappop(loads)
+        shares[share].append(index)
+        heapq.heappush(loads, (load + lengths[index], share))
+    return [sorted(share) for share in shares if share]
+
+
 class Translator(object):
     def __init__(self, model, fields, opt, out_file=None):
         self.model = model
@@ -37,11 +66,40 @@ class Translator(object):
         self.decode_extra_length = opt.decode_extra_length
         self.decode_min_length = opt.decode_min_length
         self.beam_size = opt.beam_size
+        self.batch_type = opt.batch_type
+        self.decode_strategy = opt.decode_strategy
+        self.sampling_topk = opt.sampling_topk
+        self.sampling_temp = opt.sampling_temp
         self.min_length = opt.min_length
         self.out_file = out_file
         self.tgt_eos_id = fields["tgt"].vocab.stoi[Constants.EOS_WORD]
         self.tgt_bos_id = fields["tgt"].vocab.stoi[Constants.BOS_WORD]
         self.src_eos_id = fields["src"].vocab.stoi[Constants.EOS_WORD]
+        self.n_structures = model.encoder.n_structures
+        self.pack_graphs = opt.pack_graphs
+        self.threads = opt.threads
+        self.workers = opt.workers
+        if self.workers > 1 and self.cuda:
+            raise AssertionError("-workers is only supported on CPU")
+        self.shortlist = None
+        if opt.shortlist:
+            self.shortlist = Shortlist.load(opt.shortlist, fields, self.device)
+        # Options the translations depend on, for the translation cache.
+        self.decode_options = (opt.decode_strategy, opt.beam_size, opt.min_length, opt.decode_extra_length,
+                               opt.decode_min_length, opt.shortlist)
+        self.cache = None
+        self.cache_file = opt.cache_file
+        if opt.cache_size > 0 or opt.cache_encoder_size > 0:
+            model_path = opt.models[0]
+            signature = (os.path.abspath(model_path), os.path.getsize(model_path), os.path.getmtime(model_path),
+                         opt.quantize, opt.scripted)
+            self.cache = TranslationCache(opt.cache_size, opt.cache_encoder_size, signature)
+            if self.cache_file and os.path.exists(self.cache_file):
+                self.cache.load(self.cache_file)
+        # Structure cells of the graphs, and those computed (packed or padded).
+        self.n_structure_cells = 0
+        self.n_computed_cells = 0
+        self._stats_lock = threading.Lock()
 
     def build_tokens(self, idx, side="tgt"):
         assert side in ["src", "tgt"], "side should be either src or tgt"
@@ -63,33 +121,82 @@ class Translator(object):
     def translate(self,
                   src_data_iter,
                   tgt_data_iter,
-                  structure_iter1,
-                  structure_iter2,
-                  structure_iter3,
-                  structure_iter4,
-                  structure_iter5,
+                  structure_iters,
                   batch_size,
-                  out_file=None):
-
-        data = build_dataset(self.fields,
-                             src_data_iter,
-                             tgt_data_iter,
-                             structure_iter1,
-                             structure_iter2,
-                             structure_iter3,
-                             structure_iter4,
-                             structure_iter5,
-                             use_filter_pred=False)
-
-        # for line in data:
-        #   print(line.__dict__)    {src:  , indices:   structure: }
-
-        def sort_translation(indices, translation):
-            ordered_transalation = [None] * len(translation)
-            for i, index in enumerate(indices):
-                ordered_transalation[index] = translation[i]
-            return ordered_transalation
+                  out_file=None,
+                  chunk_size=0):
+        """
+        Translate the input and write the translations to `out_file` in
+        input order. With `chunk_size` > 0 the input is read, sorted and
+        translated `chunk_size` lines at a time, and each chunk is written
+        as soon as it is done, so memory does not grow with the input.
+        """
+        assert len(structure_iters) == self.n_structures
+        data_iters = (src_data_iter, tgt_data_iter) + tuple(structure_iters)
+        if chunk_size > 0:
+            chunks = make_chunked_iterators(data_iters, chunk_size)
+        else:
+            chunks = [data_iters]
+
+        start_time = time.time()
+        print("Begin decoding ...")
+        self.batch_count = 0
+        self.n_structure_cells = 0
+        self.n_computed_cells = 0
+
+        for chunk in chunks:
+            data = build_dataset(self.fields, chunk[0], chunk[1], chunk[2:], use_filter_pred=False)
+            all_translation = self.translate_dataset(data, batch_size, self.workers)
+
+            if out_file is not None:
+                for tran in all_translation:
+                    out_file.write(tran + '\n')
+                out_file.flush()
+        if self.n_computed_cells > 0:
+            print('Structure padding efficiency: %.2f%%'
+                  % (100. * self.n_structure_cells / self.n_computed_cells))
+        if self.cache is not None:
+            print('Cache: %s' % self.cache.stats())
+            if self.cache_file:
+                self.cache.save(self.cache_file)
+        print('Decoding took %.1f minutes ...' % (float(time.time() - start_time) / 60.))
 
+    def translate_dataset(self, data, batch_size, workers=1):
+        """
+        Translate a built dataset, returns the translations in input order.
+        With `workers` > 1 it is translated in forked processes. With the
+        translation cache, the inputs found in it and the repeats of an input
+        are not translated again.
+        """
+        if self.cache is None or self.cache.translations.max_size <= 0 or self.decode_strategy == 'topk':
+            return self._translate_uncached(data, batch_size, workers)
+
+        examples = data.examples
+        keys = [TranslationCache.translation_key(ex, self.n_structures, self.decode_options) for ex in examples]
+        found = self.cache.lookup_translations(keys)
+        missing = OrderedDict()
+        for ex, key in zip(examples, keys):
+            if key not in found and key not in missing:
+                missing[key] = ex
+        if missing:
+            data.examples = list(missing.values())
+            try:
+                translations = self._translate_uncached(data, batch_size, workers)
+            finally:
+                data.examples = examples
+            for key, ex in missing.items():
+                found[key] = translations[ex.indices]
+                self.cache.put_translation(key, found[key])
+
+        all_translation = [""] * (max(ex.indices for ex in examples) + 1 if examples else 0)
+        for ex, key in zip(examples, keys):
+            all_translation[ex.indices] = found[key]
+        return all_translation
+
+    def _translate_uncached(self, data, batch_size, workers=1):
+        """ Translate a built dataset, returns the translations by example index. """
+        if workers > 1:
+            return self._translate_dataset_workers(data, batch_size, workers)
         if self.cuda:
             cur_device = "cuda"
         else:
@@ -97,15 +204,12 @@ class Translator(object):
 
         data_iter = OrderedIterator(
             dataset=data, device=cur_device,
-            batch_size=batch_size, train=False, sort=True,
-            sort_within_batch=True, shuffle=True)
+            batch_size=batch_size, batch_size_fn=self._batch_size_fn(batch_size),
+            train=False, sort=True, sort_within_batch=True, shuffle=True)
 
-        start_time = time.time()
-        print("Begin decoding ...")
-        batch_count = 0
         all_translation = []
 
-        for batch in data_iter:
+        for batch, (hyps, scores) in self._translate_batches(data_iter):
             '''
             batch
             [torchtext.data.batch.Batch of size 30]
@@ -113,7 +217,6 @@ class Translator(object):
             [.indices]:[torch.LongTensor of size 30]
             [.structure]:[torch.LongTensor of size 30x4x4]
             '''
-            hyps, scores = self.translate_batch(batch)
             assert len(batch) == len(hyps)
             batch_transtaltion = []
             for src_idx_seq, tran_idx_seq, score in zip(batch.src[0].transpose(0, 1), hyps, scores):
@@ -129,109 +232,204 @@ class Translator(object):
                 while (len(all_translation) <= index):
                     all_translation.append("")
                 all_translation[index] = tran
-            batch_count += 1
-            print("batch: " + str(batch_count) + "...")
-
-        if out_file is not None:
-            for tran in all_translation:
-                out_file.write(tran + '\n')
-        print('Decoding took %.1f minutes ...' % (float(time.time() - start_time) / 60.))
+            self.batch_count += 1
+            print("batch: " + str(self.batch_count) + "...")
+
+        return all_translation
+
+    def _batch_size_fn(self, batch_size):
+        """
+        With -batch_type tokens, the size of a batch against `batch_size`:
+        its graphs times the larger of the structure cells of the longest,
+        (n + 1)^2 per channel for n concepts, and its target cells, the beam
+        rows times the decoding length. A graph over the budget gets a batch
+        of its own.
+        """
+        if self.batch_type != 'tokens':
+            return None
+        beam_size = self.beam_size if self.decode_strategy == 'beam' else 1
+        longest = [0]
+
+        def batch_size_fn(new, count, sofar):
+            if count == 1:
+                longest[0] = 0
+            # Concepts and EOS
+            longest[0] = max(longest[0], len(new.src) + 1)
+            size = count * max(longest[0] ** 2 * self.n_structures,
+                               beam_size * (longest[0] + self.decode_extra_length))
+            # torchtext would yield an empty batch before a first graph over budget.
+            return min(size, batch_size) if count == 1 else size
+        return batch_size_fn
+
+    def _translate_dataset_workers(self, data, batch_size, n_workers):
+        """
+        Translate a built dataset in `n_workers` forked processes, which
+        share the model copy-on-write, each on a share of the sentences of
+        about the same total source length. The translations are merged in
+        input order, and the log of each worker is printed once it is done.
+        """
+        ctx = multiprocessing.get_context('fork')
+        shares = balance_shares([len(ex.src) for ex in data.examples], n_workers)
+        workers = []
+        for share in shares:
+            reader, writer = ctx.Pipe(duplex=False)
+            process = ctx.Process(target=self._translate_share, args=(data, share, batch_size, n_workers, writer))
+            process.start()
+            writer.close()
+            workers.append((process, reader))
+
+        all_translation = [""] * (max(ex.indices for ex in data.examples) + 1)
+        errors = []
+        for share, (process, reader) in zip(shares, workers):
+            try:
+                result = reader.recv()
+            except EOFError:
+                process.join()
+                result = {'error': "A worker exited with code %s" % process.exitcode}
+            process.join()
+            if 'error' in result:
+                errors.append(result['error'])
+                continue
+            print(result['log'], end='')
+            for ex in (data.examples[i] for i in share):
+                all_translation[ex.indices] = result['translations'][ex.indices]
+            with self._stats_lock:
+                self.batch_count += result['batch_count']
+                self.n_structure_cells += result['n_structure_cells']
+                self.n_computed_cells += result['n_computed_cells']
+        if errors:
+            raise RuntimeError("Translation failed in %d of %d workers:\n%s"
+                               % (len(errors), len(workers), '\n'.join(errors)))
+        return all_translation
+
+    def _translate_share(self, data, share, batch_size, n_workers, writer):
+        """ Translate the examples `share` of `data` in a worker and send the results to `writer` """
+        torch.set_num_threads(max(1, torch.get_num_threads() // n_workers))
+        self.batch_count = 0
+        self.n_structure_cells = 0
+        self.n_computed_cells = 0
+        data.examples = [data.examples[i] for i in share]
+        log = io.StringIO()
+        try:
+            with contextlib.redirect_stdout(log):
+                translations = self._translate_uncached(data, batch_size)
+            result = {'translations': translations, 'log': log.getvalue(), 'batch_count': self.batch_count,
+                      'n_structure_cells': self.n_structure_cells, 'n_computed_cells': self.n_computed_cells}
+        except Exception:
+            result = {'error': traceback.format_exc()}
+        writer.send(result)
+        writer.close()
+
+    def _translate_batches(self, data_iter):
+        """
+        Yield every batch of `data_iter` with its hypotheses and scores, in
+        order. With `self.threads` > 1 the batches are decoded by a pool of
+        threads sharing the model, each with its own decoder state.
+        """
+        if self.threads <= 1:
+            for batch in data_iter:
+                yield batch, self.translate_batch(batch)
+            return
+
+        # Iterated, as the length of a torchtext iterator with a batch_size_fn is not defined.
+        batches = [batch for batch in data_iter]
+        with ThreadPoolExecutor(max_workers=self.threads) as pool:
+            for batch, result in zip(batches, pool.map(self.translate_batch, batches)):
+                yield batch, result
+
+    def _encode(self, src_seq, structures, src_lengths):
+        """ The encoder output of a batch, `[len x batch x hidden]` """
+        packing = None
+        if self.pack_graphs:
+            packing = pack_graphs(src_seq, structures, src_lengths,
+                                  self.model.encoder.embeddings.word_padding_idx,
+                                  self.model.encoder.structure_embeddings.word_padding_idx)
+            n_computed_cells = packing.n_packed_cells
+        else:
+            n_computed_cells = src_seq.size(1) * src_seq.size(0) ** 2
+        with self._stats_lock:
+            self.n_computed_cells += n_computed_cells
+        _, src_enc, _ = self.model.encoder(src_seq, structures, packing=packing)
+        return src_enc
+
+    def _encode_cached(self, src_seq, structures, src_lengths):
+        """
+        The encoder output of a batch, `[len x batch x hidden]`, with the
+        sentences found in the encoder cache taken from it, and only the
+        others encoded, once each, as a batch of their own.
+        """
+        keys = TranslationCache.encoder_keys(src_seq, structures, src_lengths)
+        cached = self.cache.lookup_encodings(keys)
+        # The first sentence of every key not in the cache
+        first = OrderedDict()
+        for i, (key, enc) in enumerate(zip(keys, cached)):
+            if enc is None:
+                first.setdefault(key, i)
+        missing = list(first.values())
+        if len(missing) == len(keys):
+            src_enc = self._encode(src_seq, structures, src_lengths)
+        else:
+            src_enc = None
+            if missing:
+                index = torch.tensor(missing, device=src_seq.device)
+                lengths = src_lengths.index_select(0, index)
+                length = int(lengths.max())
+                missing_enc = self._encode(src_seq[:length].index_select(1, index),
+                                           [s[:length, :length].index_select(2, index) for s in structures],
+                                           lengths)
+                src_enc = missing_enc.new_zeros((src_seq.size(0), src_seq.size(1), missing_enc.size(2)))
+                src_enc[:length].index_copy_(1, index, missing_enc)
+            for i, (key, enc) in enumerate(zip(keys, cached)):
+                if enc is None and first[key] != i:
+                    src_enc[:, i] = src_enc[:, first[key]]
+                elif enc is not None:
+                    if src_enc is None:
+                        src_enc = enc.new_zeros((src_seq.size(0), src_seq.size(1), enc.size(1)))
+                    src_enc[:enc.size(0), i] = enc.to(src_enc.device)
+        for key, i in first.items():
+            self.cache.put_encoding(key, src_enc[:int(src_lengths[i]), i].clone())
+        return src_enc
+
+    def _target_words(self, vocab_ids):
+        '''
+        The generator, BOS and EOS ids to decode with: over the whole target
+        vocabulary, or over the shortlist `vocab_ids` with the words indexed
+        in it.
+        '''
+        if vocab_ids is None:
+            return self.model.generator, self.tgt_bos_id, self.tgt_eos_id
+        bos_id, eos_id = torch.searchsorted(vocab_ids, vocab_ids.new_tensor([self.tgt_bos_id,
+                                                                             self.tgt_eos_id])).tolist()
+        return Shortlist.generator(self.model.generator, vocab_ids), bos_id, eos_id
 
     def translate_batch(self, batch):
-        def get_inst_idx_to_tensor_position_map(inst_idx_list):
-            ''' Indicate the position of an instance in a tensor. '''
-            return {inst_idx: tensor_position for tensor_position, inst_idx in enumerate(inst_idx_list)}
-
-        def collect_active_part(beamed_tensor, curr_active_inst_idx, n_prev_active_inst, n_bm):
-            ''' Collect tensor parts associated to active instances. '''
-
-            _, *d_hs = beamed_tensor.size()
-            n_curr_active_inst = len(curr_active_inst_idx)
-            new_shape = (n_curr_active_inst * n_bm, *d_hs)
-
-            beamed_tensor = beamed_tensor.view(n_prev_active_inst, -1)
-            beamed_tensor = beamed_tensor.index_select(0, curr_active_inst_idx)
-            beamed_tensor = beamed_tensor.view(*new_shape)
-
-            return beamed_tensor
-
-        def beam_decode_step(inst_dec_beams, len_dec_seq, inst_idx_to_position_map, n_bm):
-            ''' Decode and update beam status, and then return active beam idx '''
-
-            # len_dec_seq: i (starting from 0)
-
-            def prepare_beam_dec_seq(inst_dec_beams):
-                dec_seq = [b.get_last_target_word() for b in inst_dec_beams if not b.done]
-                # dec_seq: [(beam_size)] * batch_size
-                dec_seq = torch.stack(dec_seq).to(self.device)
-                # dec_seq: (batch_size, beam_size)
-                dec_seq = dec_seq.view(1, -1)
-                # dec_seq: (1, batch_size * beam_size)
-                return dec_seq
-
-            def predict_word(dec_seq, n_active_inst, n_bm, len_dec_seq):
-                # dec_seq: (1, batch_size * beam_size)
-                dec_output, *_ = self.model.decoder(dec_seq, step=len_dec_seq)
-                # dec_output: (1, batch_size * beam_size, hid_size)
-                word_prob = self.model.generator(dec_output.squeeze(0))
-                # word_prob: (batch_size * beam_size, vocab_size)
-                word_prob = word_prob.view(n_active_inst, n_bm, -1)
-                # word_prob: (batch_size, beam_size, vocab_size)
-
-                return word_prob
-
-            def collect_active_inst_idx_list(inst_beams, word_prob, inst_idx_to_position_map):
-                active_inst_idx_list = []
-                select_indices_array = []
-                for inst_idx, inst_position in inst_idx_to_position_map.items():
-                    is_inst_complete = inst_beams[inst_idx].advance(word_prob[inst_position])
-                    if not is_inst_complete:
-                        active_inst_idx_list += [inst_idx]
-                        select_indices_array.append(inst_beams[inst_idx].get_current_origin() + inst_position * n_bm)
-                if len(select_indices_array) > 0:
-                    select_indices = torch.cat(select_indices_array)
-                else:
-                    select_indices = None
-                return active_inst_idx_list, select_indices
-
-            n_active_inst = len(inst_idx_to_position_map)
-
-            dec_seq = prepare_beam_dec_seq(inst_dec_beams)
+        def beam_decode_step(beam, len_dec_seq):
+            ''' Decode one step of the active sentences, update their beams and return whether any is left '''
+            n_active_inst = beam.n_active
+            dec_seq = beam.get_last_target_word().reshape(1, -1)
+            if vocab_ids is not None:
+                dec_seq = vocab_ids[dec_seq]
             # dec_seq: (1, batch_size * beam_size)
-            word_prob = predict_word(dec_seq, n_active_inst, n_bm, len_dec_seq)
-
-            # Update the beam with predicted word prob information and collect incomplete instances
-            active_inst_idx_list, select_indices = collect_active_inst_idx_list(
-                inst_dec_beams, word_prob, inst_idx_to_position_map)
-
-            if select_indices is not None:
-                assert len(active_inst_idx_list) > 0
-                self.model.decoder.map_state(
-                    lambda state, dim: state.index_select(dim, select_indices))
-
-            return active_inst_idx_list
-
-        def collate_active_info(src_seq, src_enc, inst_idx_to_position_map, active_inst_idx_list):
-            # Sentences which are still active are collected,
-            # so the decoder will not run on completed sentences.
-            n_prev_active_inst = len(inst_idx_to_position_map)
-            active_inst_idx = [inst_idx_to_position_map[k] for k in active_inst_idx_list]
-            active_inst_idx = torch.LongTensor(active_inst_idx).to(self.device)
-
-            active_src_seq = collect_active_part(src_seq, active_inst_idx, n_prev_active_inst, n_bm)
-            active_src_enc = collect_active_part(src_enc, active_inst_idx, n_prev_active_inst, n_bm)
-            active_inst_idx_to_position_map = get_inst_idx_to_tensor_position_map(active_inst_idx_list)
-
-            return active_src_seq, active_src_enc, active_inst_idx_to_position_map
-
-        def collect_best_hypothesis_and_score(inst_dec_beams):
-            hyps, scores = [], []
-            for inst_idx in range(len(inst_dec_beams)):
-                hyp, score = inst_dec_beams[inst_idx].get_best_hypothesis()
-                hyps.append(hyp)
-                scores.append(score)
-
-            return hyps, scores
+            dec_output, *_ = self.model.decoder(dec_seq, step=len_dec_seq)
+            # dec_output: (1, batch_size * beam_size, hid_size)
+            word_prob = generator(dec_output.squeeze(0))
+            # word_prob: (batch_size * beam_size, vocab_size)
+            word_prob = word_prob.view(n_active_inst, beam.size, -1)
+            # word_prob: (batch_size, beam_size, vocab_size)
+
+            # Update the beams with predicted word prob information and drop the complete instances
+            active_positions, select_indices = beam.advance(word_prob)
+            if active_positions.size(0) == 0:
+                return False
+
+            # The source side has one entry per sentence, only drop those
+            # of the sentences that are done.
+            memory_fn = None
+            if active_positions.size(0) < n_active_inst:
+                memory_fn = lambda state, dim: state.index_select(dim, active_positions)
+            self.model.decoder.map_state(
+                lambda state, dim: state.index_select(dim, select_indices), memory_fn)
+            return True
 
         with torch.no_grad():
             # -- Encode
@@ -240,62 +438,108 @@ class Translator(object):
             # src: (seq_len_src, batch_size)
             # print(src_seq.size()) 4*30
 
-            structure1 = make_features(batch, 'structure1')
-            structure1 = structure1.transpose(0, 1)
-            structure1 = structure1.transpose(1, 2)
-            # print(structure.size()) 30*4*4
-
-            structure2 = make_features(batch, 'structure2')
-            structure2 = structure2.transpose(0, 1)
-            structure2 = structure2.transpose(1, 2)
-
-            structure3 = make_features(batch, 'structure3')
-            structure3 = structure3.transpose(0, 1)
-            structure3 = structure3.transpose(1, 2)
-
-            structure4 = make_features(batch, 'structure4')
-            structure4 = structure4.transpose(0, 1)
-            structure4 = structure4.transpose(1, 2)
+            structures = make_structure_features(batch, self.n_structures)
+            _, src_lengths = batch.src
 
-            structure5 = make_features(batch, 'structure5')
-            structure5 = structure5.transpose(0, 1)
-            structure5 = structure5.transpose(1, 2)
+            with self._stats_lock:
+                self.n_structure_cells += int((src_lengths ** 2).sum())
 
-            src_emb, src_enc, _ = self.model.encoder(src_seq, structure1, structure2, structure3, structure4,
-                                                     structure5)
-            # src_emb: (seq_len_src, batch_size, emb_size)
-            # src_end: (seq_len_src, batch_size, hid_size)
-            self.model.decoder.init_state(src_seq, src_enc)
+            if self.cache is not None and self.cache.encodings.max_size > 0:
+                src_enc = self._encode_cached(src_seq, structures, src_lengths)
+            else:
+                src_enc = self._encode(src_seq, structures, src_lengths)
+            # src_enc: (seq_len_src, batch_size, hid_size)
             src_len = src_seq.size(0)
-
-            # -- Repeat data for beam search
-            n_bm = self.beam_size
-            n_inst = src_seq.size(1)
-            self.model.decoder.map_state(lambda state, dim: tile(state, n_bm, dim=dim))
-            # src_enc: (seq_len_src, batch_size * beam_size, hid_size)
-
-            # -- Prepare beams
             decode_length = src_len + self.decode_extra_length
+            self.model.decoder.init_state(src_seq, src_enc, max_length=decode_length)
+            n_inst = src_seq.size(1)
             decode_min_length = 0
             if self.decode_min_length >= 0:
                 decode_min_length = src_len - self.decode_min_length
-            inst_dec_beams = [
-                Beam(n_bm, decode_length=decode_length, minimal_length=decode_min_length, bos_id=self.tgt_bos_id,
-                     eos_id=self.tgt_eos_id, device=self.device) for _ in range(n_inst)]
 
-            # -- Bookkeeping for active or not
-            active_inst_idx_list = list(range(n_inst))
-            inst_idx_to_position_map = get_inst_idx_to_tensor_position_map(active_inst_idx_list)
+            # -- With a shortlist, the words are decoded as indexes in it
+            vocab_ids = None
+            if self.shortlist is not None:
+                vocab_ids = self.shortlist.candidates(src_seq)
+
+            if self.decode_strategy != 'beam':
+                return self.fast_decode(n_inst, decode_length, decode_min_length, vocab_ids)
+            generator, bos_id, eos_id = self._target_words(vocab_ids)
+
+            # -- The hypotheses of a sentence share its memory, which is not
+            #    repeated for beam search
+            n_bm = self.beam_size
+
+            # -- Prepare beams
+            beam = BeamSearch(n_bm, n_inst, decode_length=decode_length, minimal_length=decode_min_length,
+                              bos_id=bos_id, eos_id=eos_id, device=self.device)
 
             # -- Decode
             for len_dec_seq in range(0, decode_length):
-                active_inst_idx_list = beam_decode_step(
-                    inst_dec_beams, len_dec_seq, inst_idx_to_position_map, n_bm)
-
-                if not active_inst_idx_list:
+                if not beam_decode_step(beam, len_dec_seq):
                     break  # all instances have finished their path to <EOS>
 
-                inst_idx_to_position_map = get_inst_idx_to_tensor_position_map(active_inst_idx_list)
-
-        batch_hyps, batch_scores = collect_best_hypothesis_and_score(inst_dec_beams)
+        batch_hyps, batch_scores = beam.get_best_hypotheses()
+        if vocab_ids is not None:
+            vocab_ids = vocab_ids.cpu().numpy()
+            batch_hyps = [vocab_ids[hyp] for hyp in batch_hyps]
         return batch_hyps, batch_scores
+
+    def fast_decode(self, n_inst, decode_length, decode_min_length, vocab_ids=None):
+        """
+        Decode the `n_inst` sentences the decoder state was initialized with,
+        keeping a single hypothesis per sentence extended with the greedy or
+        a sampled word. A sentence is dropped from the batch at its EOS.
+        With `vocab_ids`, only these target words are decoded over.
+        Returns the hypotheses and their log-probabilities.
+        """
+        generator, bos_id, eos_id = self._target_words(vocab_ids)
+        alive_seq = torch.full((n_inst, 1), bos_id, dtype=torch.long, device=self.device)
+        alive_log_prob = torch.zeros((n_inst,), dtype=torch.float, device=self.device)
+        index = torch.arange(n_inst, device=self.device)
+        hyps, scores = [None] * n_inst, [None] * n_inst
+
+        def finish(positions):
+            for position in positions.tolist():
+                sentence = index[position].item()
+                hyp = alive_seq[position, 1:]
+                if vocab_ids is not None:
+                    hyp = vocab_ids[hyp]
+                hyps[sentence] = hyp.data.cpu().numpy()
+                scores[sentence] = alive_log_prob[position].item()
+
+        for step in range(decode_length):
+            dec_seq = alive_seq[:, -1].view(1, -1)
+            if vocab_ids is not None:
+                dec_seq = vocab_ids[dec_seq]
+            dec_output, *_ = self.model.decoder(dec_seq, step=step)
+            log_probs = generator(dec_output.squeeze(0))
+            # log_probs: (n_active, vocab_size)
+            if step + 2 < decode_min_length:
+                # same minimal length, counted with BOS, as the beam search
+                log_probs[:, eos_id] = -float('inf')
+
+            if self.decode_strategy == 'greedy':
+                word_log_prob, word = log_probs.max(1)
+            else:
+                topk_log_probs, topk_ids = log_probs.topk(self.sampling_topk, 1)
+                choice = torch.multinomial(torch.softmax(topk_log_probs / self.sampling_temp, 1), 1)
+                word = topk_ids.gather(1, choice).squeeze(1)
+                word_log_prob = topk_log_probs.gather(1, choice).squeeze(1)
+            alive_seq = torch.cat((alive_seq, word.unsqueeze(1)), dim=1)
+            alive_log_prob = alive_log_prob + word_log_prob
+
+            done = word.eq(eos_id)
+            if done.any():
+                finish(done.nonzero().view(-1))
+                active = (~done).nonzero().view(-1)
+                if active.size(0) == 0:
+                    return hyps, scores
+                alive_seq = alive_seq.index_select(0, active)
+                alive_log_prob = alive_log_prob.index_select(0, active)
+                index = index.index_select(0, active)
+                select = lambda state, dim: state.index_select(dim, active)
+                self.model.decoder.map_state(select, select)
+
+        finish(torch.arange(alive_seq.size(0)))
+        return hyps, scores
@@ -0,0 +1,158 @@
+#!/usr/bin/env python
+"""
+Translation server keeping the model loaded. Requests are batched
+dynamically, see :obj:`onmt.translation_server.TranslationServer`, e.g.
+
+    python server.py -model model.pt -batch_size 30 -max_latency 10
+
+reads JSON lines on stdin, one request per line, with the concepts and
+the structure paths of every channel, as lines of the input files:
+
+    {"id": 1, "src": "concepts ...", "structures": ["paths 1 ...", ...]}
+
+and answers each on stdout as soon as it is translated, so possibly out
+of order:
+
+    {"id": 1, "translation": "..."}    or    {"id": 1, "error": "..."}
+
+{"stats": true} is answered with the latency percentiles and the batch
+fill. With -port the server listens on localhost instead, requests are
+POSTed to /translate and the statistics are at /stats.
+"""
+from __future__ import print_function
+
+import json
+import sys
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import configargparse
+import torch
+
+import onmt.opts as opts
+from onmt.translation_server import TranslationServer
+from onmt.translator import build_translator
+from utils.logging import init_logger, logger
+
+
+def serve_json_lines(server, stdin, stdout):
+    """ Answer the requests of `stdin` on `stdout` until its end """
+    lock = threading.Condition()
+    pending = [0]
+
+    def respond(response):
+        with lock:
+            stdout.write(json.dumps(response, ensure_ascii=False) + '\n')
+            stdout.flush()
+
+    def done(request, request_id):
+        if request.error is not None:
+            respond({'id': request_id, 'error': request.error})
+        else:
+            respond({'id': request_id, 'translation': request.translation})
+        with lock:
+            pending[0] -= 1
+            lock.notify_all()
+
+    for line in stdin:
+        if not line.strip():
+            continue
+        try:
+            request = json.loads(line)
+        except ValueError as e:
+            respond({'error': 'Invalid JSON: %s' % e})
+            continue
+        request_id = request.get('id')
+        if request.get('stats'):
+            respond({'id': request_id, 'stats': server.stats()})
+            continue
+        with lock:
+            pending[0] += 1
+        try:
+            server.submit(request['src'], request['structures'],
+                          lambda r, request_id=request_id: done(r, request_id))
+        except (KeyError, TypeError, ValueError) as e:
+            with lock:
+                pending[0] -= 1
+            respond({'id': request_id, 'error': 'Invalid request: %r' % e})
+
+    with lock:
+        while pending[0] > 0:
+            lock.wait()
+
+
+def serve_http(server, port):
+    """ Answer POST /translate and GET /stats on localhost:`port` """
+
+    class Handler(BaseHTTPRequestHandler):
+        def _respond(self, code, response):
+            body = json.dumps(response, ensure_ascii=False).encode('utf-8')
+            self.send_response(code)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            if self.path != '/stats':
+                return self._respond(404, {'error': 'Unknown path %s' % self.path})
+            self._respond(200, server.stats())
+
+        def do_POST(self):
+            if self.path != '/translate':
+                return self._respond(404, {'error': 'Unknown path %s' % self.path})
+            try:
+                request = json.loads(self.rfile.read(int(self.headers['Content-Length'])).decode('utf-8'))
+                src, structures = request['src'], request['structures']
+            except (KeyError, TypeError, ValueError) as e:
+                return self._respond(400, {'error': 'Invalid request: %r' % e})
+            try:
+                self._respond(200, {'id': request.get('id'), 'translation': server.translate(src, structures)})
+            except ValueError as e:
+                self._respond(400, {'id': request.get('id'), 'error': str(e)})
+            except RuntimeError as e:
+                self._respond(500, {'id': request.get('id'), 'error': str(e)})
+
+        def log_message(self, format, *args):
+            logger.debug(format % args)
+
+    httpd = ThreadingHTTPServer(('localhost', port), Handler)
+    logger.info("Serving on http://localhost:%d" % port)
+    try:
+        httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    httpd.server_close()
+
+
+def main(opt):
+    if opt.seed > 0:
+        torch.manual_seed(opt.seed)
+    if opt.threads > 1:
+        torch.set_num_threads(max(1, torch.get_num_threads() // opt.threads))
+    # Answers are the only output on stdout.
+    stdout, sys.stdout = sys.stdout, sys.stderr
+    translator = build_translator(opt)
+    server = TranslationServer(translator, opt.batch_size, opt.max_latency / 1000., opt.max_group)
+
+    if opt.port > 0:
+        serve_http(server, opt.port)
+    else:
+        serve_json_lines(server, sys.stdin, stdout)
+    logger.info("Server statistics: %s" % json.dumps(server.stats()))
+    if translator.cache is not None and translator.cache_file:
+        translator.cache.save(translator.cache_file)
+
+
+if __name__ == "__main__":
+    parser = configargparse.ArgumentParser(
+        description='server.py',
+        config_file_parser_class=configargparse.YAMLConfigFileParser,
+        formatter_class=configargparse.ArgumentDefaultsHelpFormatter)
+    opts.config_opts(parser)
+    opts.translate_opts(parser, data=False)
+    opts.server_opts(parser)
+
+    opt = parser.parse_args()
+    init_logger(opt.log_file)
+    main(opt)
@@ -12,7 +12,8 @@ import torch
 import torch.nn as nn
 
 import onmt.opts as opts
-from inputters.dataset import build_dataset_iter, load_dataset, save_fields_to_vocab, load_fields
+from inputters.dataset import build_dataset_iter, load_dataset, save_fields_to_vocab, load_fields, \
+    build_resident_batches, ResidentBatchIter
 from onmt.transformer import build_model
 from trainer import build_trainer
 from utils.logging import init_logger, logger
@@ -39,6 +40,9 @@ def _tally_parameters(model):  # 统计encoder、decoder有多少参数
 
 
 def training_opt_postprocessing(opt, device_id):
+    if opt.resident_batches and not opt.resident_data:
+        raise AssertionError("-resident_batches requires -resident_data")
+
     if torch.cuda.is_available() and not opt.gpu_ranks:
         logger.info("WARNING: You have a CUDA device, \
                 should run with -gpu_ranks")
@@ -85,7 +89,7 @@ def main(opt, device_id):  # device_id=0 only 1 GPU
         model_opt = opt
 
     # Load fields generated from preprocess phase.
-    fields = load_fields(opt, checkpoint)
+    fields = load_fields(opt, checkpoint, model_opt.structure_channels)
 
     # Build model.
     model = build_model(model_opt, opt, fields, checkpoint)
@@ -104,10 +108,30 @@ def main(opt, device_id):  # device_id=0 only 1 GPU
 
     trainer = build_trainer(opt, device_id, model, fields, optim, model_saver=model_saver)
 
-    def train_iter_fct():
-        return build_dataset_iter(load_dataset("train", opt), fields, opt)
+    if opt.resident_data:
+        # Load every shard once, epochs then only reshuffle the examples.
+        train_datasets = list(load_dataset("train", opt))
+        valid_datasets = list(load_dataset("valid", opt))
+        if opt.resident_batches:
+            train_batches = build_resident_batches(train_datasets, fields, opt)
+            valid_batches = build_resident_batches(valid_datasets, fields, opt, is_train=False)
+
+    def train_iter_fct(iter_state=None):
+        if opt.resident_batches:
+            return ResidentBatchIter(train_batches, True, iter_state=iter_state)
+        shard_offset = iter_state['shard'] if iter_state is not None else 0
+        if opt.resident_data:
+            datasets = iter(train_datasets[shard_offset:])
+        else:
+            datasets = load_dataset("train", opt, shard_offset)
+        return build_dataset_iter(datasets, fields, opt, iter_state=iter_state,
+                                  resident=opt.resident_data)
 
     def valid_iter_fct():
+        if opt.resident_batches:
+            return ResidentBatchIter(valid_batches, False)
+        if opt.resident_data:
+            return build_dataset_iter(iter(valid_datasets), fields, opt, is_train=False, resident=True)
         return build_dataset_iter(load_dataset("valid", opt), fields, opt, is_train=False)
 
     # Do training.
@@ -115,7 +139,16 @@ def main(opt, device_id):  # device_id=0 only 1 GPU
         logger.info('Starting training on GPU: %s' % opt.gpu_ranks)
     else:
         logger.info('Starting training on CPU, could be very slow')
-    trainer.train(train_iter_fct, valid_iter_fct, opt.train_steps, opt.valid_steps)
+    # Resume the data iterator where the checkpoint left it, if it was saved.
+    train_iter_state = None
+    if checkpoint is not None and opt.reset_optim != 'all':
+        train_iter_state = checkpoint.get('train_iter')
+        if train_iter_state is not None:
+            logger.info('Resuming data from shard %d, batch %d'
+                        % (train_iter_state['shard'],
+                           train_iter_state['iterator']['iterations_this_epoch']))
+    trainer.train(train_iter_fct, valid_iter_fct, opt.train_steps, opt.valid_steps,
+                  train_iter_state=train_iter_state)
 
     if opt.tensorboard:
         trainer.report_manager.tensorboard_writer.close()
@@ -153,7 +186,7 @@ class ModelSaver(object):
         if keep_checkpoint > 0:
             self.checkpoint_queue = deque([], maxlen=keep_checkpoint)
 
-    def maybe_save(self, step):
+    def maybe_save(self, step, train_iter_state=None):
         """
         Main entry point for model saver
         It wraps the `_save` method with checks and apply `keep_checkpoint`
@@ -165,7 +198,7 @@ class ModelSaver(object):
         if step % self.save_checkpoint_steps != 0:
             return
 
-        chkpt, chkpt_name = self._save(step)
+        chkpt, chkpt_name = self._save(step, train_iter_state)
 
         if self.keep_checkpoint > 0:
             if len(self.checkpoint_queue) == self.checkpoint_queue.maxlen:
@@ -173,11 +206,12 @@ class ModelSaver(object):
                 self._rm_checkpoint(todel)
             self.checkpoint_queue.append(chkpt_name)
 
-    def _save(self, step):
+    def _save(self, step, train_iter_state=None):
         """ Save a resumable checkpoint.
 
         Args:
             step (int): step number
+            train_iter_state (dict): position of the train iterator
 
         Returns:
             checkpoint: the saved object
@@ -200,6 +234,7 @@ class ModelSaver(object):
             'vocab': save_fields_to_vocab(self.fields),
             'opt': self.model_opt,
             'optim': self.optim,
+            'train_iter': train_iter_state,
         }
 
         logger.info("Saving checkpoint %s_step_%d.pt" % (self.base_path, step))